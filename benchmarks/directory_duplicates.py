@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+Time duplicate folder detection on synthetic trees.
+
+The trees repeat the layout of tests/test_duplicates.py: top level folders
+each holding a chain like b/c/d/e/f, where some chains end in another name,
+so there are both duplicated and unique subtrees.
+
+    new: Directory.duplicates, grouping on hashes computed once
+    old: the algorithm it replaced, hashing again for every ancestor check
+         and comparing candidates recursively (only run up to --old-limit)
+
+By default the trees are built in memory, to time the algorithms alone.
+With --disk they are created in a temporary folder and scanned first.
+
+Run from the repository root:
+    python -m benchmarks.directory_duplicates --directories 100000 1000000
+"""
+import os
+import gc
+import time
+import shutil
+import argparse
+import tempfile
+
+from common import hashing
+from duplicates import Directory
+
+CHAIN = "bcdef"
+ENDINGS = "fg"
+
+
+def layout(count: int):
+    """Relative paths of about count directories, parents first."""
+    paths = []
+    top = 0
+    while len(paths) < count:
+        path = f"t{top}"
+        paths.append(path)
+        for name in CHAIN[:-1] + ENDINGS[top % 3 == 0]:
+            path = os.path.join(path, name)
+            paths.append(path)
+        top += 1
+    return paths
+
+
+def in_memory(paths):
+    root = Directory.__new__(Directory)
+    nodes = {"": root}
+    for path in [""] + paths:
+        node = nodes[path] if path == "" else Directory.__new__(Directory)
+        node.directory = os.path.join("/synthetic", path)
+        node.subdirectories = {}
+        node.sizes = {}
+        node.content = []
+        node.depth = 0
+        node.truncated = False
+        node._hash = None
+        node._names = ()
+        if path:
+            parent = nodes[os.path.dirname(path)]
+            node.parent = parent
+            parent.subdirectories[os.path.basename(path)] = node
+            parent.content.append(os.path.basename(path))
+            nodes[path] = node
+        else:
+            node.parent = None
+    return root
+
+
+def old_hash(directory):
+    h = hashing.new(hashing.fastest())
+    h.update(repr(directory.content).encode('utf8'))
+    for sub in directory.subdirectories.values():
+        h.update(old_hash(sub).encode('utf8'))
+    return h.hexdigest()
+
+
+def old_equal(a, b):
+    if a.content != b.content or len(a.subdirectories) != len(b.subdirectories):
+        return False
+    return all(name in b.subdirectories and old_equal(sub, b.subdirectories[name])
+               for name, sub in a.subdirectories.items())
+
+
+def old_hashes(directory):
+    hashes = [(old_hash(directory), directory)]
+    for sub in directory.subdirectories.values():
+        hashes += old_hashes(sub)
+    return hashes
+
+
+def old_duplicates(directory):
+    result = {}
+    for h, d in sorted(old_hashes(directory), key=lambda x: x[0]):
+        if h not in result:
+            result[h] = [d]
+        elif old_equal(d, result[h][0]):
+            result[h].append(d)
+
+    result = {key: value for (key, value) in result.items() if len(value) > 1}
+    output = {}
+    for key, value in result.items():
+        v = value[0]
+        add = True
+        while v.parent is not None:
+            v = v.parent
+            if old_hash(v) in result:
+                add = False
+        if add:
+            output[key] = value
+    return output
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark duplicate folder detection")
+    parser.add_argument('--directories', type=int, nargs='+', default=[100000, 1000000])
+    parser.add_argument('--old-limit', type=int, default=20000, help="Largest tree to run the old algorithm on")
+    parser.add_argument('--disk', action='store_true', help="Create the trees on disk and scan them")
+    args = parser.parse_args()
+
+    for count in args.directories:
+        paths = layout(count)
+        folder = None
+        if args.disk:
+            folder = tempfile.mkdtemp()
+            for path in paths:
+                os.mkdir(os.path.join(folder, path))
+            start = time.perf_counter()
+            root = Directory(folder)
+            print(f"{len(paths):8} directories scan: {time.perf_counter() - start:8.2f} s")
+        else:
+            root = in_memory(paths)
+        # As duplicates.py does once the tree is scanned.
+        gc.freeze()
+
+        try:
+            start = time.perf_counter()
+            groups = root.duplicates()
+            print(f"{len(paths):8} directories  new: {time.perf_counter() - start:8.2f} s, {len(groups)} group(s)")
+
+            if len(paths) <= args.old_limit:
+                root.invalidate()
+                start = time.perf_counter()
+                groups = old_duplicates(root)
+                print(f"{len(paths):8} directories  old: {time.perf_counter() - start:8.2f} s, {len(groups)} group(s)")
+        finally:
+            if folder is not None:
+                shutil.rmtree(folder)
+            gc.unfreeze()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Compare ways of reading a file for hashing across file sizes.
+
+    read:     the old loop of 64 KiB f.read() calls, one bytes object per block
+    readinto: hashing.hash_file, adaptive block size into a reusable buffer
+    mmap:     hashing.hash_file_mmap
+
+Run from the repository root:
+    python -m benchmarks.file_hashing --sizes 1 16 256
+"""
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+from pathlib import Path
+from typing import Callable, Tuple
+
+from common import hashing
+
+
+def hash_read_loop(path: Path, algorithm: str) -> str:
+    h = hashing.new(algorithm)
+    with open(path, 'rb') as f:
+        fb = f.read(hashing.BLOCK_SIZE)
+        while len(fb) > 0:
+            h.update(fb)
+            fb = f.read(hashing.BLOCK_SIZE)
+    return h.hexdigest()
+
+
+METHODS: dict = {
+    'read': hash_read_loop,
+    'readinto': hashing.hash_file,
+    'mmap': hashing.hash_file_mmap,
+}
+
+
+def bench(method: Callable[[Path, str], str], path: Path, algorithm: str, rounds: int) -> Tuple[float, int]:
+    """Best MB/s over a number of rounds, and peak traced allocation in bytes."""
+    size = path.stat().st_size
+    best = 0.0
+    for _ in range(rounds):
+        start = time.perf_counter()
+        method(path, algorithm)
+        best = max(best, size / (1024 * 1024) / (time.perf_counter() - start))
+
+    tracemalloc.start()
+    method(path, algorithm)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark file reading for hashing")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 16, 256], help="File sizes in MiB")
+    parser.add_argument('--algorithm', choices=list(hashing.ALGORITHMS), default=hashing.fastest())
+    parser.add_argument('--rounds', type=int, default=3)
+    args = parser.parse_args()
+
+    folder = Path(tempfile.mkdtemp())
+    try:
+        print(f"Algorithm {args.algorithm}, best of {args.rounds}, page cache warm")
+        for size in args.sizes:
+            path = folder / f"{size}.bin"
+            with open(path, 'wb') as f:
+                for _ in range(size):
+                    f.write(os.urandom(1024 * 1024))
+
+            for name, method in METHODS.items():
+                rate, peak = bench(method, path, args.algorithm, args.rounds)
+                print(f"{size:6} MiB {name:>8}: {rate:8.1f} MB/s, peak allocation {peak / 1024:8.1f} KiB")
+            path.unlink()
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == "__main__":
+    main()
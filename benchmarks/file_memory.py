@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+Compare the memory held by index entries.
+
+    dict:  the old File, an instance dict with a Path and hex digest strings
+    slots: file_index.File, slots, raw digests and shared directory strings
+
+Run from the repository root:
+    python -m benchmarks.file_memory --files 100000
+"""
+import os
+import time
+import argparse
+import tracemalloc
+from pathlib import Path
+from typing import Callable, List
+
+from file_index import File
+
+
+class DictFile:
+    def __init__(self, path: str, size: int, quickhash: str, checksum: str, mtime: float, ctime: float, inode: int):
+        self.path = Path(path)
+        self.size = size
+        self.mtime = mtime
+        self.ctime = ctime
+        self.inode = inode
+        self.algorithm = 'md5'
+        self._quickhash = quickhash
+        self._fingerprint = None
+        self._hash = checksum
+        self.hash_depth = 0
+
+
+def build(cls: Callable, count: int) -> List[object]:
+    files = []
+    for i in range(count):
+        path = os.path.join('/data', 'photos', str(i // 100), f'IMG_{i:06}.jpg')
+        files.append(cls(path, i, f'{i:032x}', f'{i * 7:032x}', 1.0e9 + i, 1.0e9 + i, i))
+    return files
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark memory used by index entries")
+    parser.add_argument('--files', type=int, default=100000)
+    args = parser.parse_args()
+
+    for name, cls in (('dict', DictFile), ('slots', File)):
+        tracemalloc.start()
+        start = time.perf_counter()
+        files = build(cls, args.files)
+        elapsed = time.perf_counter() - start
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{name:>6}: {current / args.files:6.0f} bytes per file, built in {elapsed:.2f} s")
+        del files
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Crash-safe file writing, with optional gzip or zstd compression picked from the file name.
+
+A file is written to a temporary file next to it, flushed to disk and then
+renamed over the original, so readers see either the old or the new content.
+"""
+import io
+import os
+import gzip
+import stat
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+from typing import IO, Iterator, Union
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+def _fsync_directory(folder: Path):
+    try:
+        fd = os.open(folder, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _compressed(raw: IO[bytes], name: str) -> IO[bytes]:
+    if name.endswith('.gz'):
+        return gzip.GzipFile(fileobj=raw, mode='wb')
+    if name.endswith('.zst'):
+        if zstandard is None:
+            raise ValueError("Writing .zst files needs the zstandard package")
+        return zstandard.ZstdCompressor().stream_writer(raw, closefd=False)
+    return raw
+
+
+def _mode(path: Path) -> int:
+    """Permissions for path: those of the file it replaces, or the default for a new file."""
+    try:
+        return stat.S_IMODE(os.stat(path).st_mode)
+    except FileNotFoundError:
+        umask = os.umask(0)
+        os.umask(umask)
+        return 0o666 & ~umask
+
+
+@contextmanager
+def atomic_write(path: Union[str, Path]) -> Iterator[IO[str]]:
+    """Open path for writing text, replacing it only once everything is written."""
+    path = Path(path)
+    fd, temporary = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with open(fd, 'wb') as raw:
+            stream = _compressed(raw, path.name)
+            text = io.TextIOWrapper(stream, encoding='utf8')
+            yield text
+            text.flush()
+            text.detach()
+            if stream is not raw:
+                stream.close()
+            raw.flush()
+            # mkstemp makes the file readable by its owner only.
+            os.chmod(raw.fileno(), _mode(path))
+            os.fsync(raw.fileno())
+        os.replace(temporary, path)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+    _fsync_directory(path.parent)
+
+
+def open_text(path: Union[str, Path]) -> IO[str]:
+    """Open a file for reading text, decompressing gzip or zstd content."""
+    with open(path, 'rb') as f:
+        magic = f.read(4)
+
+    if magic.startswith(GZIP_MAGIC):
+        return gzip.open(path, 'rt', encoding='utf8')
+    if magic.startswith(ZSTD_MAGIC):
+        if zstandard is None:
+            raise ValueError(f"Reading {path} needs the zstandard package")
+        return zstandard.open(path, 'rt', encoding='utf8')
+    return open(path, encoding='utf8')
@@ -0,0 +1,157 @@
+"""
+Selectable hash algorithms for the file comparing scripts.
+
+md5, sha1 and blake2b come from hashlib. xxh3 and blake3 are available when
+the xxhash and blake3 packages are installed.
+"""
+import os
+import mmap
+import time
+import hashlib
+from functools import lru_cache, partial
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Protocol, Union
+
+
+DEFAULT_ALGORITHM = 'md5'
+QUICKHASH_SIZE = 1024
+BLOCK_SIZE = 65536
+MAX_BLOCK_SIZE = 1024 * 1024
+FINGERPRINT_BLOCKS = 8
+
+
+class Hasher(Protocol):
+    def update(self, data: bytes, /) -> None: ...
+    def hexdigest(self) -> str: ...
+
+
+ALGORITHMS: Dict[str, Callable[[], Hasher]] = {
+    'md5': hashlib.md5,
+    'sha1': hashlib.sha1,
+    'blake2b': partial(hashlib.blake2b, digest_size=16),
+}
+
+try:
+    import xxhash
+    ALGORITHMS['xxh3'] = xxhash.xxh3_128
+except ImportError:
+    pass
+
+try:
+    import blake3
+    ALGORITHMS['blake3'] = blake3.blake3
+except ImportError:
+    pass
+
+
+@lru_cache(maxsize=None)
+def fastest() -> str:
+    """The fastest available algorithm on this machine, for hashes that are never stored.
+
+    Which of the hashlib algorithms wins depends on the CPU (sha1 is fast where
+    there are SHA extensions), so they are timed on a small buffer once.
+    """
+    data = bytes(1024 * 1024)
+    timings = {}
+    for algorithm in ALGORITHMS:
+        start = time.perf_counter()
+        hash_bytes(data, algorithm)
+        timings[algorithm] = time.perf_counter() - start
+    return min(timings, key=lambda algorithm: timings[algorithm])
+
+
+def new(algorithm: str = DEFAULT_ALGORITHM) -> Hasher:
+    try:
+        return ALGORITHMS[algorithm]()
+    except KeyError:
+        raise ValueError(f"Unknown hash algorithm {algorithm}, choose one of: {', '.join(ALGORITHMS)}")
+
+
+def hash_bytes(data: bytes, algorithm: str = DEFAULT_ALGORITHM) -> str:
+    h = new(algorithm)
+    h.update(data)
+    return h.hexdigest()
+
+
+def hash_head(path: Union[str, Path], size: int = QUICKHASH_SIZE, algorithm: str = DEFAULT_ALGORITHM) -> str:
+    """Hash the first size bytes of a file."""
+    with open(path, 'rb') as f:
+        return hash_bytes(f.read(size), algorithm)
+
+
+def block_size(size: int) -> int:
+    """Read size for a file of size bytes, growing with the file up to MAX_BLOCK_SIZE."""
+    block = BLOCK_SIZE
+    while block < MAX_BLOCK_SIZE and block * 64 < size:
+        block *= 2
+    return block
+
+
+def hash_file(path: Union[str, Path], algorithm: str = DEFAULT_ALGORITHM) -> str:
+    """Hash the whole content of a file.
+
+    The file is read unbuffered into one reusable buffer, so no bytes object
+    is allocated per block and memory use does not grow with the file.
+    """
+    h = new(algorithm)
+    with open(path, 'rb', buffering=0) as f:
+        buffer = bytearray(block_size(os.fstat(f.fileno()).st_size))
+        view = memoryview(buffer)
+        while n := f.readinto(buffer):
+            h.update(view[:n])
+    return h.hexdigest()
+
+
+def hash_file_mmap(path: Union[str, Path], algorithm: str = DEFAULT_ALGORITHM) -> str:
+    """Hash the whole content of a file through a memory map.
+
+    Avoids copying into user space at all, but a file truncated while it is
+    being hashed kills the process with SIGBUS, so hash_file is the default.
+    """
+    h = new(algorithm)
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return h.hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            if hasattr(m, 'madvise'):
+                m.madvise(mmap.MADV_SEQUENTIAL)
+            h.update(m)
+    return h.hexdigest()
+
+
+def hash_blocks(path: Union[str, Path], offsets: Iterable[int], block_size: int = BLOCK_SIZE,
+                algorithm: str = DEFAULT_ALGORITHM) -> str:
+    """Hash the blocks of a file starting at each of offsets, read into one reusable buffer."""
+    h = new(algorithm)
+    buffer = bytearray(block_size)
+    view = memoryview(buffer)
+    with open(path, 'rb', buffering=0) as f:
+        for offset in offsets:
+            f.seek(offset)
+            n = 0
+            while n < block_size and (read := f.readinto(view[n:])):
+                n += read
+            h.update(view[:n])
+    return h.hexdigest()
+
+
+def sample_offsets(size: int, blocks: int = FINGERPRINT_BLOCKS, block_size: int = BLOCK_SIZE) -> List[int]:
+    """Offsets of the first and last block of a file, and of blocks evenly spaced between them."""
+    last = max(0, size - block_size)
+    return sorted({last * i // (blocks + 1) for i in range(blocks + 2)})
+
+
+def fingerprint(path: Union[str, Path], blocks: int = FINGERPRINT_BLOCKS, algorithm: str = DEFAULT_ALGORITHM) -> str:
+    """Hash of a sample of blocks spread over a file, prefixed by the number of blocks sampled.
+
+    Catches files that differ somewhere past an identical header without
+    reading them in full. Fingerprints are only comparable when made with
+    the same number of blocks, hence the prefix.
+    """
+    offsets = sample_offsets(os.path.getsize(path), blocks)
+    return f"{blocks}:{hash_blocks(path, offsets, algorithm=algorithm)}"
+
+
+def fingerprint_size(blocks: int = FINGERPRINT_BLOCKS) -> int:
+    """Bytes read by a fingerprint."""
+    return (blocks + 2) * BLOCK_SIZE
@@ -0,0 +1,70 @@
+"""
+Replacing a file by a hard link or a reflink to an identical file.
+
+A reflink, made with the FICLONE ioctl on btrfs, XFS and other copy on write
+file systems, shares the data of the source but stays a separate file, so a
+later change to one of them does not show in the other. A hard link is the
+same file under another name.
+
+The link is made under a temporary name next to the target and renamed
+over it, so the target is never missing, and is left as it was if linking
+fails.
+"""
+import os
+import shutil
+import fcntl
+import tempfile
+from pathlib import Path
+from typing import Union
+
+# _IOW(0x94, 9, int) from linux/fs.h
+FICLONE = 0x40049409
+
+METHODS = ('hardlink', 'reflink')
+
+
+def _temporary_name(target: Path) -> Path:
+    fd, name = tempfile.mkstemp(dir=target.parent, prefix=f".{target.name}.", suffix=".tmp")
+    os.close(fd)
+    return Path(name)
+
+
+def hardlink(source: Union[str, Path], target: Union[str, Path]):
+    """Replace target by a hard link to source."""
+    target = Path(target)
+    temporary = _temporary_name(target)
+    try:
+        os.unlink(temporary)
+        os.link(source, temporary)
+        os.replace(temporary, target)
+    except BaseException:
+        if temporary.exists():
+            os.unlink(temporary)
+        raise
+
+
+def reflink(source: Union[str, Path], target: Union[str, Path]):
+    """Replace target by a reflink to source, keeping the permissions and times of target.
+
+    Raises OSError where the file system can not share data between the files.
+    """
+    target = Path(target)
+    temporary = _temporary_name(target)
+    try:
+        with open(source, 'rb') as src, open(temporary, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        shutil.copystat(target, temporary)
+        os.replace(temporary, target)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+
+
+def link(source: Union[str, Path], target: Union[str, Path], method: str):
+    """Replace target by a link to source made with method, one of METHODS."""
+    if method == 'hardlink':
+        hardlink(source, target)
+    elif method == 'reflink':
+        reflink(source, target)
+    else:
+        raise ValueError(f"Unknown link method {method}, choose one of: {', '.join(METHODS)}")
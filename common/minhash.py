@@ -0,0 +1,110 @@
+"""
+MinHash signatures and locality sensitive hashing, for finding sets that are mostly the same.
+
+A signature keeps, for each of a number of random hash functions, the
+smallest hash of any member of a set. Two signatures agree in a position
+with a probability equal to the Jaccard similarity of their sets, and the
+signature of a union is the position-wise minimum of the signatures of its
+parts, so signatures of nested folders can be built bottom-up.
+
+LSH cuts signatures into bands and only sets sharing a whole band become
+candidates, so similar sets are found without comparing every pair.
+"""
+import random
+import hashlib
+from typing import Dict, Hashable, Iterable, Iterator, List, Set, Tuple
+
+PERMUTATIONS = 128
+THRESHOLD = 0.95
+# Chance a pair right at the threshold is found.
+RECALL = 0.99
+
+# A Mersenne prime, feature hashes are reduced below it.
+PRIME = (1 << 61) - 1
+MAX_HASH = PRIME
+
+Signature = List[int]
+
+# Fixed, so signatures made by separate runs can be compared.
+_random = random.Random(20240611)
+_PARAMETERS = [(_random.randrange(1, PRIME), _random.randrange(0, PRIME)) for _ in range(PERMUTATIONS)]
+
+
+def feature(data: bytes) -> int:
+    """A hash of one member of a set, below PRIME.
+
+    Hashes that differ by a multiple of PRIME would get the same values
+    in every position of a signature, so they are reduced first.
+    """
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'little') % PRIME
+
+
+def empty(permutations: int = PERMUTATIONS) -> Signature:
+    """Signature of the empty set, merging it with another signature gives that signature."""
+    return [MAX_HASH] * permutations
+
+
+def signature(features: Iterable[int], permutations: int = PERMUTATIONS) -> Signature:
+    """Signature of a set of feature hashes."""
+    features = [x for x in features]
+    if not features:
+        return empty(permutations)
+    return [min((a * x + b) % PRIME for x in features) for a, b in _PARAMETERS[:permutations]]
+
+
+def merge(*signatures: Signature) -> Signature:
+    """Signature of the union of the sets of signatures."""
+    return [min(values) for values in zip(*signatures)]
+
+
+def similarity(a: Signature, b: Signature) -> float:
+    """Estimated Jaccard similarity of the sets behind two signatures."""
+    return sum(x == y for x, y in zip(a, b)) / len(a)
+
+
+def jaccard(a: Set[Hashable], b: Set[Hashable]) -> float:
+    """Exact Jaccard similarity of two sets."""
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+def bands(threshold: float = THRESHOLD, permutations: int = PERMUTATIONS) -> Tuple[int, int]:
+    """Number of bands and rows per band, for pairs of threshold similarity to become candidates.
+
+    Pairs of similarity s share a band with probability 1 - (1 - s^rows)^bands.
+    The most rows, so the fewest dissimilar candidates, are picked for which
+    that is still RECALL at threshold.
+    """
+    best = (permutations, 1)
+    for rows in range(1, permutations + 1):
+        count = permutations // rows
+        if 1 - (1 - threshold ** rows) ** count < RECALL:
+            break
+        best = (count, rows)
+    return best
+
+
+class LSH:
+    """An index of signatures, giving the pairs of keys that are probably similar."""
+
+    def __init__(self, threshold: float = THRESHOLD, permutations: int = PERMUTATIONS):
+        self.bands, self.rows = bands(threshold, permutations)
+        self._buckets: List[Dict[int, List[Hashable]]] = [{} for _ in range(self.bands)]
+
+    def add(self, key: Hashable, signature: Signature):
+        for band, buckets in enumerate(self._buckets):
+            start = band * self.rows
+            # Only a hash of the band is kept, a chance collision just gives a candidate too many.
+            buckets.setdefault(hash(tuple(signature[start:start + self.rows])), []).append(key)
+
+    def candidates(self) -> Iterator[Tuple[Hashable, Hashable]]:
+        """Each pair of keys that share a band, once."""
+        seen: Set[Tuple[Hashable, Hashable]] = set()
+        for buckets in self._buckets:
+            for keys in buckets.values():
+                for i, a in enumerate(keys):
+                    for b in keys[i + 1:]:
+                        if (a, b) not in seen:
+                            seen.add((a, b))
+                            yield a, b
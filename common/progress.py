@@ -0,0 +1,168 @@
+"""
+Counters for long running file scans, reported as a live progress line and a JSON summary.
+
+Work is counted per phase: walk, stat, quickhash, fingerprint, hash and
+save. Each phase counts files (directories for walk, commits for save),
+bytes, system calls like scandir, stat and open, and cache hits and
+misses: entries reused from an index for stat, and hashes found in the
+index for the hashing phases. From these come files and bytes per second,
+hit rates and, where the total is known, the time left.
+
+walker and file_index report to the shared tracker on their own. Set the
+environment variable PROGRESS to show the live line on stderr, and
+PROGRESS_STATS to a file name to have the summary written there at exit.
+"""
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional, TextIO
+
+# Seconds between updates of the live line.
+INTERVAL = 0.5
+
+
+def _duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02}:{seconds:02}"
+
+
+class Phase:
+    """What was done in one phase, and when."""
+    __slots__ = ('name', 'files', 'bytes', 'calls', 'hits', 'misses', 'busy', 'total', 'started', 'updated')
+
+    def __init__(self, name: str):
+        self.name = name
+        self.files = 0
+        self.bytes = 0
+        self.calls = 0
+        self.hits = 0
+        self.misses = 0
+        # Seconds spent working, summed over threads, so it can be more than wall.
+        self.busy = 0.0
+        # Files expected in this phase, if known.
+        self.total: Optional[int] = None
+        self.started: Optional[float] = None
+        self.updated: Optional[float] = None
+
+    @property
+    def wall(self) -> float:
+        if self.started is None or self.updated is None:
+            return 0.0
+        return self.updated - self.started
+
+    def rate(self, amount: int) -> float:
+        return amount / self.wall if self.wall > 0 else 0.0
+
+    @property
+    def hit_rate(self) -> Optional[float]:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else None
+
+    @property
+    def eta(self) -> Optional[float]:
+        if self.total is None or self.files == 0:
+            return None
+        return max(0, self.total - self.files) / self.rate(self.files) if self.rate(self.files) > 0 else None
+
+    def describe(self) -> str:
+        parts = [f"{self.name} {self.files}", f"{self.rate(self.files):.0f}/s"]
+        if self.bytes:
+            parts.append(f"{self.rate(self.bytes) / (1024 * 1024):.1f} MB/s")
+        if self.hit_rate is not None:
+            parts.append(f"{self.hit_rate:.0%} hit")
+        if self.total is not None:
+            parts.append(f"of {self.total}")
+        if self.eta is not None:
+            parts.append(f"ETA {_duration(self.eta)}")
+        return " ".join(parts)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'files': self.files, 'bytes': self.bytes, 'calls': self.calls, 'hits': self.hits,
+                'misses': self.misses, 'hit_rate': self.hit_rate, 'busy': round(self.busy, 3),
+                'wall': round(self.wall, 3), 'files_per_second': round(self.rate(self.files), 1),
+                'bytes_per_second': round(self.rate(self.bytes), 1)}
+
+
+class Progress:
+    """Phases of a run, safe to count from several threads."""
+
+    def __init__(self, live: bool = False, stats: Optional[str] = None, stream: TextIO = sys.stderr):
+        self.phases: Dict[str, Phase] = {}
+        self.live = live
+        self.stats = stats
+        self.stream = stream
+        self.started = time.monotonic()
+        self._cpu = os.times()
+        self._lock = threading.Lock()
+        self._shown = 0.0
+        self._line_length = 0
+
+    def phase(self, name: str) -> Phase:
+        with self._lock:
+            if name not in self.phases:
+                self.phases[name] = Phase(name)
+            return self.phases[name]
+
+    def count(self, name: str, files: int = 0, bytes: int = 0, calls: int = 0, hits: int = 0, misses: int = 0,
+              busy: float = 0.0):
+        phase = self.phase(name)
+        now = time.monotonic()
+        with self._lock:
+            if phase.started is None:
+                phase.started = now - busy
+            phase.updated = now
+            phase.files += files
+            phase.bytes += bytes
+            phase.calls += calls
+            phase.hits += hits
+            phase.misses += misses
+            phase.busy += busy
+        if self.live and now - self._shown >= INTERVAL:
+            self.show()
+
+    @contextmanager
+    def timed(self, name: str, **counts: int) -> Iterator[Phase]:
+        """Count the time spent in the block, and counts, for phase name."""
+        start = time.perf_counter()
+        try:
+            yield self.phase(name)
+        finally:
+            self.count(name, busy=time.perf_counter() - start, **counts)
+
+    def line(self) -> str:
+        return " | ".join(phase.describe() for phase in self.phases.values())
+
+    def show(self):
+        self._shown = time.monotonic()
+        line = self.line()
+        self.stream.write("\r" + line.ljust(self._line_length))
+        self.stream.flush()
+        self._line_length = len(line)
+
+    def summary(self) -> Dict[str, Any]:
+        cpu = os.times()
+        return {
+            'elapsed': round(time.monotonic() - self.started, 3),
+            # Close to elapsed, or above it with threads, when CPU bound. Far below when waiting on I/O.
+            'cpu': round((cpu.user - self._cpu.user) + (cpu.system - self._cpu.system), 3),
+            'phases': {name: phase.to_dict() for name, phase in self.phases.items()},
+        }
+
+    def finish(self):
+        """End the live line and write the summary, if asked for."""
+        if self.live and self._line_length:
+            self.show()
+            self.stream.write("\n")
+            self._line_length = 0
+        if self.stats:
+            with open(self.stats, 'w') as f:
+                json.dump(self.summary(), f, indent=4)
+
+
+tracker = Progress(live=bool(os.environ.get("PROGRESS")), stats=os.environ.get("PROGRESS_STATS"))
+atexit.register(tracker.finish)
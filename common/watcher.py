@@ -0,0 +1,197 @@
+"""
+Reporting changes below a directory as they happen.
+
+On Linux inotify is used through ctypes, with a watch on every directory in
+the tree. Elsewhere, or when inotify runs out of watches, the tree is walked
+and compared with the previous walk every few seconds instead.
+
+Changes are reported as sets of paths that may have been created, modified,
+moved or deleted. Whoever consumes them stats each path to find out which.
+A reported directory means anything below it may have changed.
+"""
+import os
+import time
+import errno
+import ctypes
+import ctypes.util
+import select
+import struct
+from typing import Dict, Iterable, Iterator, Optional, Set, Tuple, Union
+
+from common import walker
+from common.logger import setup_logger
+logger = setup_logger(__file__)
+
+
+# Wait this long for a burst of events to end before reporting it, but never longer than MAX_DELAY.
+DELAY = 1.0
+MAX_DELAY = 10.0
+POLL_INTERVAL = 30.0
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+              IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW)
+EVENT = struct.Struct("iIII")
+
+
+class Inotify:
+    """A watch on every directory below top."""
+
+    def __init__(self, top: str, ignores: Iterable[str] = ()):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        try:
+            self._add_watch = libc.inotify_add_watch
+            init = libc.inotify_init1
+        except AttributeError:
+            raise OSError("inotify is not available on this system")
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+
+        self.fd = init(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        self.top = top
+        self.ignores = tuple(ignores)
+        self.ignore = walker._ignore_pattern(self.ignores)
+        self.directories: Dict[int, str] = {}
+        try:
+            self.watch_tree(top)
+        except OSError:
+            self.close()
+            raise
+
+    def watch(self, directory: str):
+        wd = self._add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            # Gone again already, the event that removed it is on its way.
+            if error in (errno.ENOENT, errno.ENOTDIR):
+                return
+            raise OSError(error, f"Could not watch {directory}: {os.strerror(error)}")
+        self.directories[wd] = directory
+
+    def watch_tree(self, top: str):
+        for directory, _ in walker.walk(top, self.ignores, jobs=1):
+            self.watch(directory)
+
+    def read(self, timeout: Optional[float] = None) -> Set[str]:
+        """Paths changed within timeout seconds, waiting for the first one if timeout is None."""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return set()
+
+        changed: Set[str] = set()
+        data = os.read(self.fd, 64 * 1024)
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                logger.warning("Too many changes at once in %s, rescanning it", self.top)
+                changed.add(self.top)
+                continue
+            if mask & IN_IGNORED:
+                self.directories.pop(wd, None)
+                continue
+
+            directory = self.directories.get(wd)
+            if directory is None:
+                continue
+            if not name:
+                # The watched directory itself was moved or deleted.
+                changed.add(directory)
+                continue
+            if self.ignore is not None and self.ignore.match(name):
+                continue
+
+            path = os.path.join(directory, name)
+            changed.add(path)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                try:
+                    self.watch_tree(path)
+                except OSError as e:
+                    logger.warning("Changes below %s will be missed: %s", path, e)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _snapshot(top: str, ignores: Iterable[str], jobs: int) -> Dict[str, Tuple[int, float, int]]:
+    return {entry.path: (entry.size, entry.mtime, entry.inode) for entry in walker.files(top, ignores, jobs)}
+
+
+def poll(top: Union[str, os.PathLike], ignores: Iterable[str] = (), interval: float = POLL_INTERVAL,
+         jobs: int = walker.DEFAULT_JOBS) -> Iterator[Set[str]]:
+    """Yield the paths that changed since the call, found by walking top every interval seconds."""
+    top = os.fspath(top)
+    return _poll(top, ignores, interval, jobs, _snapshot(top, ignores, jobs))
+
+
+def _poll(top: str, ignores: Iterable[str], interval: float, jobs: int,
+          previous: Dict[str, Tuple[int, float, int]]) -> Iterator[Set[str]]:
+    while True:
+        time.sleep(interval)
+        current = _snapshot(top, ignores, jobs)
+        changed = {path for path in previous.keys() | current.keys() if previous.get(path) != current.get(path)}
+        previous = current
+        if changed:
+            yield changed
+
+
+def changes(top: Union[str, os.PathLike], ignores: Iterable[str] = (), delay: float = DELAY,
+            poll_interval: float = POLL_INTERVAL, jobs: int = walker.DEFAULT_JOBS) -> Iterator[Set[str]]:
+    """Yield sets of paths below top that changed since the call, until the caller stops.
+
+    The watches are set up before this returns, so changes made while the
+    caller is still busy, like with a first full walk of top, are reported
+    too. With inotify, events are collected until none have arrived for
+    delay seconds, so a file being written or a large copy is reported in
+    a few batches instead of once per event. Without it, top is polled
+    every poll_interval seconds.
+    """
+    top = os.fspath(top)
+    try:
+        inotify = Inotify(top, ignores)
+    except OSError as e:
+        logger.warning("Can not use inotify (%s), polling %s every %s seconds", e, top, poll_interval)
+        return poll(top, ignores, poll_interval, jobs)
+    return _changes(inotify, delay)
+
+
+def _changes(inotify: Inotify, delay: float) -> Iterator[Set[str]]:
+    with inotify:
+        while True:
+            changed = inotify.read()
+            if not changed:
+                continue
+            deadline = time.monotonic() + MAX_DELAY
+            while time.monotonic() < deadline:
+                more = inotify.read(delay)
+                if not more:
+                    break
+                changed |= more
+            yield changed
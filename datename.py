@@ -1,16 +1,14 @@
 #!/usr/bin/env python3
 import exiftool
 from pathlib import Path
-from hashlib import md5
+
+from common import hashing
 
 HASHES = {}
 
 
 def file_hash(f: Path):
-    with f.open(mode='rb') as inp:
-        h = md5()
-        h.update(inp.read())
-        return h.hexdigest()
+    return hashing.hash_file(f, hashing.fastest())
 
 
 def main():
@@ -1,12 +1,17 @@
 #!/usr/bin/env python3
 
 import os
-import hashlib
+import gc
+import time
 import json
 import argparse
 
-from typing import Dict, TypedDict, List
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
 
+from common import hashing, minhash, walker
+from common.progress import tracker
 from common.logger import setup_logger
 logger = setup_logger(__file__)
 
@@ -14,43 +19,93 @@ logger = setup_logger(__file__)
 IGNORES = ['.git', '.vscode']
 
 class Directory(object):
-    def __init__(self, directory, recurse=True, parent=None):
+    def __init__(self, directory, recurse=True, parent=None, max_depth=None):
         logger.info("Opening: {}".format(directory))
         self.directory = os.path.abspath(directory)
         self.subdirectories = {}
-        self.content = sorted(os.listdir(directory))
+        self.sizes = {}
+        self.content = []
         self.parent = parent
         self.depth = 0
+        # True when the subdirectories were left out for being past max_depth.
+        self.truncated = False
+        self._hash = None
+        self._names = ()
 
+        self._read()
         if recurse:
-            self.scan()
-    
-    def scan(self):
-        self.depth = 0
-        for entry in self.content:
-            if entry in IGNORES:
+            self.scan(max_depth, reread=False)
+
+    def _read(self):
+        """List the directory, keeping the names of subdirectories for scan.
+
+        Whether an entry is a directory comes from the directory listing
+        itself, only files are stat'ed, for their size. Symbolic links to
+        directories are not followed.
+        """
+        start = time.perf_counter()
+        self.content = []
+        self.sizes = {}
+        names = []
+        try:
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    self.content.append(entry.name)
+                    if entry.name in IGNORES:
+                        continue
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            names.append(entry.name)
+                        else:
+                            self.sizes[entry.name] = entry.stat().st_size
+                    except OSError:
+                        continue
+        except OSError as e:
+            logger.warning("Could not read {}: {}".format(self.directory, e))
+        self.content.sort()
+        self._names = sorted(names)
+        tracker.count('walk', files=1, calls=1, busy=time.perf_counter() - start)
+        tracker.count('stat', files=len(self.sizes), calls=len(self.sizes))
+
+    def scan(self, max_depth=None, reread=True):
+        """Build the tree of subdirectories, at most max_depth levels down.
+
+        Uses an explicit stack instead of recursion, so the depth of the
+        tree is not limited by the recursion limit. Directories whose
+        subdirectories were left out are marked truncated.
+        """
+        self.invalidate()
+        if reread:
+            self._read()
+
+        stack = [(self, 0)]
+        while stack:
+            directory, level = stack.pop()
+            names, directory._names = directory._names, ()
+            directory.subdirectories = {}
+            directory.truncated = bool(names) and max_depth is not None and level >= max_depth
+            if directory.truncated:
                 continue
-            fullpath = os.path.join(self.directory, entry)
-            if os.path.isdir(fullpath):
-                subdir = Directory(fullpath,  parent=self)
-                self.subdirectories[entry] = subdir
-                self.depth = max(self.depth, subdir.depth)
+            for name in names:
+                subdir = Directory(os.path.join(directory.directory, name), recurse=False, parent=directory)
+                directory.subdirectories[name] = subdir
+                stack.append((subdir, level + 1))
+
+        for directory in self._bottom_up():
+            directory.depth = 1 + max(sub.depth for sub in directory.subdirectories.values()) if directory.subdirectories else 0
+
+    def invalidate(self):
+        """Forget the hash of this directory and of the directories it is in."""
+        directory = self
+        while directory is not None:
+            directory._hash = None
+            directory = directory.parent
 
     def __eq__(self, other):
-        if self.content != other.content:
-            return False
-        
-        if len(self.subdirectories) != len(other.subdirectories):
-            return False
-        
-        for name, sub in self.subdirectories.items():
-            if name not in other.subdirectories:
-                return False
-            
-            if sub != other.subdirectories[name]:
-                return False
+        if not isinstance(other, Directory):
+            return NotImplemented
 
-        return True
+        return self.hash == other.hash
 
     @property
     def size(self):
@@ -58,64 +113,73 @@ class Directory(object):
     
     @property
     def hash(self):
-        h = hashlib.md5()
-        h.update(json.dumps(self.content).encode('utf8'))
-        for name, sub in self.subdirectories.items():
-            h.update(sub.hash.encode('utf8'))
-        
+        """Merkle hash of the names in the directory, the sizes of its files and the hashes of its subdirectories.
+
+        Computed bottom-up for the whole tree on first use and kept until
+        the directory or one below it is scanned again.
+        """
+        if self._hash is None:
+            for directory in self._bottom_up():
+                if directory._hash is None:
+                    directory._hash = directory._digest()
+
+        return self._hash
+
+    def _top_down(self):
+        """This directory and all below it, every directory before its subdirectories."""
+        stack = [self]
+        while stack:
+            directory = stack.pop()
+            yield directory
+            stack.extend(reversed(directory.subdirectories.values()))
+
+    def _bottom_up(self):
+        """This directory and all below it, every directory after its subdirectories."""
+        return reversed([directory for directory in self._top_down()])
+
+    def _digest(self):
+        h = hashing.new(hashing.fastest())
+        h.update("\0".join(self.content).encode('utf8', 'surrogateescape'))
+        h.update(b"\1")
+        h.update("\0".join(f"{name}\0{size}" for name, size in sorted(self.sizes.items())).encode('utf8', 'surrogateescape'))
+        h.update(b"\1")
+        h.update("".join(sub._hash for sub in self.subdirectories.values()).encode('ascii'))
+        if self.truncated:
+            # What is below is unknown, so neither this nor any directory it is in may match another.
+            h.update(b"\2")
+            h.update(self.directory.encode('utf8', 'surrogateescape'))
+
         return h.hexdigest()
     
     def hashes(self):
-        _hashes = []
-        _hashes.append((self.hash, self))
-        
-        for name, sub in self.subdirectories.items():
-            _hashes += sub.hashes()  # [(sub.hash, sub)]
-        
-        return _hashes
+        self.hash
+        return [(directory._hash, directory) for directory in self._top_down()]
     
     def duplicates(self):
-        hashes = self.hashes()
-        hashes = list(sorted(hashes, key=lambda x: x[0]))
-        hashes = list(sorted(hashes, key=lambda x: -len(x[0])))
-
-        result = {}
-
-        for h in hashes:
-            if h[0] not in result:
-                result[h[0]] = [h[1]]
-                continue
-
-            if h[0] in result:
-                if h[1] == result[h[0]][0]:
-                    result[h[0]].append(h[1])
-
-        
-
-        result = {key: value for (key, value) in result.items() if len(value) > 1}
-        output = {}
-        for key, value in result.items():
-            v = value[0]
-            add = True
-            while v.parent is not None:
-                v = v.parent
-                if v.hash in result:
-                    add = False
-            if add:
-                output[key] = value
-            
-        return output
+        """Groups of identical directories, keyed on their hash.
+
+        A group is left out when one of its directories is inside a
+        directory that is itself duplicated, as it is part of a larger
+        duplicate. One pass groups the directories on their cached hashes,
+        and one more marks, parents first, the directories inside a
+        duplicated one.
+        """
+        groups = {}
+        for h, directory in self.hashes():
+            groups.setdefault(h, []).append(directory)
+        result = {key: value for (key, value) in groups.items() if len(value) > 1}
+
+        inside = set()
+        for directory in self._top_down():
+            parent = directory.parent
+            if directory is not self and (id(parent) in inside or parent._hash in result):
+                inside.add(id(directory))
+
+        return {key: value for (key, value) in result.items() if not any(id(v) in inside for v in value)}
     
     def has_child(self, other):
-        for subdir in self.subdirectories:
-            if other.directory == os.path.join(self.directory, subdir):
-                return True
-
-        for h, sub in self.subdirectories.items():
-            if sub.has_child(other):
-                return True
-        
-        return False
+        """True if other is somewhere below this directory."""
+        return other.directory.startswith(os.path.join(self.directory, ""))
 
 
 def argparser():
@@ -123,6 +187,16 @@ def argparser():
     parser.add_argument('--folders', action="store_true")
     parser.add_argument('--files', action="store_true")
     parser.add_argument('--dry-run', action="store_true", default=False)
+    parser.add_argument('--algorithm', choices=list(hashing.ALGORITHMS), default=None,
+                        help="Hash algorithm, the fastest one available by default")
+    parser.add_argument('--max-depth', type=int, default=None, help="Compare folders at most this deep")
+    parser.add_argument('--similar', action="store_true", help="Find folders that are mostly the same")
+    parser.add_argument('--threshold', type=float, default=minhash.THRESHOLD,
+                        help="Part of the files two folders must share to be similar")
+    parser.add_argument('--min-files', type=int, default=2, help="Leave out folders with fewer files")
+    parser.add_argument('--jobs', type=int, default=walker.DEFAULT_JOBS, help="Files read at once")
+    parser.add_argument('--fingerprint-blocks', type=int, default=hashing.FINGERPRINT_BLOCKS,
+                        help="Blocks sampled from a file before it is hashed in full")
     return parser
 
 def main():
@@ -154,8 +228,10 @@ def main():
             print("")
 
 
-def folders():
-    directory = Directory(".")
+def folders(max_depth=None):
+    directory = Directory(".", max_depth=max_depth)
+    # The tree is kept until exit, keep the garbage collector from going through it again and again.
+    gc.freeze()
     logger.info(" ")
     duplicates = directory.duplicates()
     for d, values in duplicates.items():
@@ -165,89 +241,179 @@ def folders():
         logger.info(" ")
 
 
-class FileInfo(TypedDict):
-    fullpath: str
-    depth: int
-    size: int
-    start: str
-
-def files(dry_run=False):
-    found_files: Dict[str, FileInfo] = {}
-
-    # Find all the files in the directory
-    for root, dirs, files in os.walk('.', topdown=True):
-        dirs[:] = [d for d in dirs if d not in IGNORES]
-
+def _feature(entry, blocks, algorithm):
+    """Feature hash of a file, from its name, size and a fingerprint of its content."""
+    try:
+        with tracker.timed('fingerprint', files=1, bytes=min(entry.size, hashing.fingerprint_size(blocks)), calls=1):
+            fingerprint = hashing.fingerprint(entry.path, blocks, algorithm)
+    except OSError as e:
+        logger.warning("Could not read {}: {}".format(entry.path, e))
+        fingerprint = ""
+    return minhash.feature("{}\0{}\0{}".format(entry.name, entry.size, fingerprint).encode('utf8', 'surrogateescape'))
+
+
+def similar_folders(top='.', threshold=minhash.THRESHOLD, algorithm=None,
+                    blocks=hashing.FINGERPRINT_BLOCKS, jobs=walker.DEFAULT_JOBS, min_files=2) -> List[Tuple[float, str, str]]:
+    """Pairs of folders whose files are at least threshold the same, most similar first.
+
+    A folder is the set of (name, size, fingerprint) of the files in and
+    below it, and two folders are compared by the Jaccard similarity of
+    those sets, so a renamed or an extra file only lowers it a little while
+    same named files with other content count as different. MinHash
+    signatures are built bottom-up and LSH picks the candidate pairs, which
+    are then compared exactly. A pair is left out when folders around them
+    are a pair too, and so are folders inside each other and folders with
+    fewer than min_files files.
+    """
+    algorithm = algorithm or hashing.fastest()
+    top = os.path.normpath(top)
+    own = {}
+    entries = []
+    for directory, files in walker.walk(top, IGNORES, jobs):
+        own[directory] = []
+        entries.extend(files)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for entry, feature in zip(entries, executor.map(partial(_feature, blocks=blocks, algorithm=algorithm), entries)):
+            own[os.path.dirname(entry.path)].append(feature)
+    del entries
+
+    lsh = minhash.LSH(threshold)
+    children = {}
+    signatures = {}
+    counts = {}
+    # Deepest first, so every folder comes after the folders in it.
+    for directory in sorted(own, key=lambda d: d.count(os.path.sep), reverse=True):
+        signature = minhash.signature(own[directory])
+        if directory in signatures:
+            signature = minhash.merge(signature, signatures.pop(directory))
+        count = len(own[directory]) + counts.pop(directory, 0)
+        if count >= min_files:
+            lsh.add(directory, signature)
+        if directory != top:
+            parent = os.path.dirname(directory)
+            signatures[parent] = minhash.merge(signatures[parent], signature) if parent in signatures else signature
+            counts[parent] = counts.get(parent, 0) + count
+            children.setdefault(parent, []).append(directory)
+
+    cache = {}
+    def below(directory):
+        if directory not in cache:
+            features = set()
+            stack = [directory]
+            while stack:
+                d = stack.pop()
+                features.update(own[d])
+                stack.extend(children.get(d, ()))
+            cache[directory] = features
+        return cache[directory]
+
+    pairs = {}
+    for a, b in lsh.candidates():
+        if a.startswith(os.path.join(b, "")) or b.startswith(os.path.join(a, "")):
+            continue
+        similarity = minhash.jaccard(below(a), below(b))
+        if similarity >= threshold:
+            pairs[frozenset((a, b))] = similarity
+
+    def ancestors(directory):
+        """The directory and the folders it is in, up to top."""
+        yield directory
+        while directory != top:
+            directory = os.path.dirname(directory)
+            yield directory
+
+    def nested(a, b):
+        """True if a pair of folders around a and b, other than a and b themselves, is similar."""
+        return any(frozenset((x, y)) in pairs for x in ancestors(a) for y in ancestors(b) if (x, y) != (a, b))
+
+    result = [(similarity, *sorted(pair)) for pair, similarity in pairs.items() if not nested(*pair)]
+    return sorted(result, key=lambda r: (-r[0], r[1], r[2]))
+
+
+def similar(threshold=minhash.THRESHOLD, algorithm=None, jobs=walker.DEFAULT_JOBS, min_files=2,
+            blocks=hashing.FINGERPRINT_BLOCKS):
+    for similarity, a, b in similar_folders('.', threshold, algorithm, blocks, jobs, min_files):
+        print("Folders that are {:.0%} the same:".format(similarity))
+        print(a)
+        print(b)
+        print("")
+
+
+def _digest(path, size, kind, blocks, algorithm):
+    """Fingerprint or full hash of a file, None if it can not be read."""
+    try:
+        if kind == 'fingerprint':
+            with tracker.timed('fingerprint', files=1, bytes=min(size, hashing.fingerprint_size(blocks)), calls=1):
+                return hashing.fingerprint(path, blocks, algorithm)
+        with tracker.timed('hash', files=1, bytes=size, calls=1):
+            return hashing.hash_file(path, algorithm)
+    except OSError as e:
+        logger.warning("Could not read {}: {}".format(path, e))
+        return None
+
+
+def _split(groups, kind, executor, blocks, algorithm):
+    """Split groups of files further on their fingerprint or hash, keeping the groups of two or more.
+
+    Groups are keyed on a tuple starting with the size of their files, the
+    digest is added to it.
+    """
+    todo = [(key, path) for key, paths in groups.items() for path in paths]
+    digests = executor.map(lambda item: _digest(item[1], item[0][0], kind, blocks, algorithm), todo)
+    split = {}
+    for (key, path), digest in zip(todo, digests):
+        if digest is not None:
+            split.setdefault(key + (digest,), []).append(path)
+    return {key: paths for key, paths in split.items() if len(paths) > 1}
+
+
+def _count(groups):
+    print("{} files in {} sets".format(sum(len(paths) for paths in groups.values()), len(groups)))
+
+
+def files(dry_run=False, algorithm=None, jobs=walker.DEFAULT_JOBS, blocks=hashing.FINGERPRINT_BLOCKS):
+    """Print groups of identical files.
+
+    Files are grouped on size, then on a fingerprint of a few blocks
+    sampled over the file, on a pool of jobs threads. Only files in groups
+    that still hold more than one file and that are larger than the
+    fingerprint reads are hashed in full. Every read goes into a buffer of
+    bounded size, so memory use does not grow with the size of the files.
+    """
+    algorithm = algorithm or hashing.fastest()
+    by_size: Dict[Tuple, List[str]] = {}
+    found = 0
+    for root, entries in walker.walk('.', IGNORES, jobs):
         logger.info("Scanning {}".format(root))
-        for file in files:
-            fullpath = os.path.join(root, file)
-            depth = root.count(os.path.sep)
-            stat = os.stat(fullpath)
-            found_files[fullpath] = {
-                'fullpath': fullpath,
-                'depth': depth,
-                'size': stat.st_size,
-                'start': ''
-            }
-    
-    print("Found {} files".format(len(found_files.keys())))
+        for entry in entries:
+            by_size.setdefault((entry.size,), []).append(entry.path)
+            found += 1
+    print("Found {} files".format(found))
+
+    groups = {key: paths for key, paths in by_size.items() if len(paths) > 1}
+    del by_size
+    _count(groups)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        groups = _split(groups, 'fingerprint', executor, blocks, algorithm)
+        # A fingerprint reads the whole of files up to this size already.
+        sampled = {key: paths for key, paths in groups.items() if key[0] > hashing.fingerprint_size(blocks)}
+        groups = {key: paths for key, paths in groups.items() if key[0] <= hashing.fingerprint_size(blocks)}
+        groups.update(_split(sampled, 'hash', executor, blocks, algorithm))
+    _count(groups)
 
-    files_by_size: Dict[int, List[FileInfo]] = {}
-    for file, data in found_files.items():
-        if data['size'] not in files_by_size:
-            files_by_size[data['size']] = []
-        
-        files_by_size[data['size']].append(data)
-    
-    files_by_size = {key: value for (key, value) in files_by_size.items() if len(value) > 1}
-    number_of_files = 0
-    for key, value in files_by_size.items():
-        number_of_files += len(value)
-    print("{} files in {} sets".format(number_of_files, len(files_by_size.keys())))
-
-    delete = []
-    for size, files in files_by_size.items():
-        for file in files:
-            with open(file['fullpath'], 'rb') as f:
-                h = hashlib.md5()
-                h.update(f.read(max(1024 * 1024, size)))
-                file['start'] = h.hexdigest()
-
-        file_starts = set([file['start'] for file in files])
-        if len(file_starts) == len(files):
-            delete.append(size)
-    
-    for size in delete:
-        del files_by_size[size]
-
-    number_of_files = 0
-    for key, value in files_by_size.items():
-        number_of_files += len(value)
-    print("{} files in {} sets".format(number_of_files, len(files_by_size.keys())))
-
-    files_by_size_and_hash: Dict[int, Dict[str, List[FileInfo]]] = {}
-    for size, data in files_by_size.items():
-        if size not in files_by_size_and_hash:
-            files_by_size_and_hash[size] = {}
-        
-        t = files_by_size_and_hash[size]
-        for f in data:
-            h = f['start']
-            if h not in t:
-                t[h] = []
-            t[f['start']].append(f)
-  
     if not dry_run:
         print("Deleting files")
-        for size, hashes in files_by_size_and_hash.items():
-            print("Size: {}".format(size))
-            for h, files in hashes.items():
-                if len(files) < 2:
-                    continue
-                print(f"Hash: {h}")
-                for f in files:
-                    print(f['fullpath'])
-                print("")
+        size = None
+        for key in sorted(groups):
+            if key[0] != size:
+                size = key[0]
+                print("Size: {}".format(size))
+            print(f"Hash: {key[-1]}")
+            for path in sorted(groups[key]):
+                print(path)
+            print("")
     
 
 def main2():
@@ -255,9 +421,11 @@ def main2():
     args = parser.parse_args()
 
     if args.files:
-        files(args.dry_run)
+        files(args.dry_run, args.algorithm, args.jobs, args.fingerprint_blocks)
+    elif args.similar:
+        similar(args.threshold, args.algorithm, args.jobs, args.min_files, args.fingerprint_blocks)
     else:
-        folders()
+        folders(args.max_depth)
 
 
 if __name__ == "__main__":
@@ -2,16 +2,39 @@
 import os
 import re
 import sys
+import stat
+import errno
 import shutil
 from pathlib import Path
-import hashlib
-from typing import Dict, Any, List, Optional, TypedDict, Union, Tuple
-
+import time
+import heapq
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack
+from functools import partial
+from itertools import groupby, islice, repeat
+from typing import Callable, Dict, Any, Iterable, Iterator, List, Optional, Set, TypedDict, Union, Tuple
+
+import csv
 import json
+import sqlite3
+import weakref
 import click
 
+from common import atomic, hashing, links, walker, watcher
+from common.hashing import DEFAULT_ALGORITHM, FINGERPRINT_BLOCKS, QUICKHASH_SIZE
+from common.progress import tracker
+
+INDEX_FILE_PREFIX = ".GSN_file_index"
+INDEX_FILE_NAME = INDEX_FILE_PREFIX + ".json"
+INDEX_DB_NAME = INDEX_FILE_PREFIX + ".db"
 
-INDEX_FILE_NAME = ".GSN_file_index.json"
+BATCH_SIZE = 1000
+# Stay well below SQLite's limit on the number of query parameters.
+MAX_QUERY_PARAMETERS = 500
+# Commit computed hashes at least this often, so an interrupted run keeps most of its work.
+WRITE_BACK_FILES = 1000
+WRITE_BACK_SECONDS = 30.0
+DEFAULT_JOBS = os.cpu_count() or 1
 
 
 class FileInfo(TypedDict):
@@ -19,272 +42,1356 @@ class FileInfo(TypedDict):
     size: int
     quickhash: str
     hash: str
+    mtime: float
+    ctime: float
+    inode: int
+    algorithm: str
+    fingerprint: str
+    device: int
+
+
+# Indexes written before the algorithm was recorded used md5.
+LEGACY_ALGORITHM = 'md5'
 
 
-class JsonEncoder(json.JSONEncoder):
-    def default(self, o: Any):
-        if isinstance(o, File):
-            return o.to_dict()
-        return json.JSONEncoder.default(self, o)
+def _hash_job(path: str, kind: str, algorithm: str, fingerprint_blocks: int) -> Tuple[Optional[str], int]:
+    """Hash a single file for HashPool, returning the digest and number of bytes read."""
+    try:
+        size = os.path.getsize(path)
+        if kind == 'quickhash':
+            return hashing.hash_head(path, algorithm=algorithm), min(QUICKHASH_SIZE, size)
+        if kind == 'fingerprint':
+            return (hashing.fingerprint(path, fingerprint_blocks, algorithm),
+                    min(hashing.fingerprint_size(fingerprint_blocks), size))
+        return hashing.hash_file(path, algorithm), size
+    except OSError:
+        return None, 0
+
+
+def batched(iterable: Iterable[Any], size: int = BATCH_SIZE) -> Iterator[List[Any]]:
+    iterator = iter(iterable)
+    while batch := [x for x in islice(iterator, size)]:
+        yield batch
+
+
+def _digest(value: Optional[str]) -> Optional[Union[bytes, str]]:
+    """Hex digest as raw bytes, half the size in memory."""
+    if value is None:
+        return None
+    try:
+        return bytes.fromhex(value)
+    except ValueError:
+        return value
+
+
+def _hex(value: Optional[Union[bytes, str]]) -> Optional[str]:
+    if isinstance(value, bytes):
+        return value.hex()
+    return value
 
 
 class File:
-    path: Path
+    """An indexed file.
+
+    Kept small, as an index can hold millions of them: no instance dict,
+    digests as raw bytes, and the path split into a directory string shared
+    by all files in that directory and the file name.
+    """
+    __slots__ = ('directory', 'name', 'size', 'mtime', 'ctime', 'inode', 'device', 'algorithm',
+                 '_quickhash', '_fingerprint', '_hash')
+
+    directory: str
+    name: str
     size: int
-    _quickhash: Any
-    _hash: Any
+    mtime: Optional[float]
+    ctime: Optional[float]
+    inode: Optional[int]
+    device: Optional[int]
+    algorithm: str
+    _quickhash: Optional[Union[bytes, str]]
+    _fingerprint: Optional[str]
+    _hash: Optional[Union[bytes, str]]
+
+    def __init__(self, path: Union[str, Path], size: Optional[int] = None, quickhash: Optional[str] = None,
+                 checksum: Optional[str] = None, mtime: Optional[float] = None, ctime: Optional[float] = None,
+                 inode: Optional[int] = None, algorithm: str = DEFAULT_ALGORITHM, fingerprint: Optional[str] = None,
+                 device: Optional[int] = None):
+        directory, self.name = os.path.split(path)
+        self.directory = sys.intern(directory)
+        if size is None:
+            file_stat = os.stat(path)
+            size, mtime, ctime, inode = file_stat.st_size, file_stat.st_mtime, file_stat.st_ctime, file_stat.st_ino
+            device = file_stat.st_dev
+        self.size = size
+        self.mtime = mtime
+        self.ctime = ctime
+        self.inode = inode
+        self.device = device
+        self.algorithm = algorithm
+        self._hash = _digest(checksum)
+        self._quickhash = _digest(quickhash)
+        self._fingerprint = fingerprint
 
-    def __init__(self, path: Path, size: Optional[int] = None, quickhash: Optional[str] = None, checksum: Optional[str] = None):
-        self.path = path
-        self.size = size or path.stat().st_size
-        self._hash = checksum
-        self._quickhash = quickhash
-        self.hash_depth = 0
+    @property
+    def path(self) -> Path:
+        return Path(self.directory, self.name)
 
-        self.quickhash
+    @classmethod
+    def from_entry(cls, entry: walker.Entry, algorithm: str = DEFAULT_ALGORITHM):
+        return cls(entry.path, entry.size, mtime=entry.mtime, ctime=entry.ctime, inode=entry.inode,
+                   algorithm=algorithm, device=entry.device)
 
     @classmethod
     def from_dict(cls, data: FileInfo, parent: Path):
-        return cls(parent / Path(data['path']), data['size'], data['quickhash'], data['hash'])
+        return cls(os.path.join(parent, data['path']), data['size'], data['quickhash'], data['hash'],
+                   data.get('mtime'), data.get('ctime'), data.get('inode'), data.get('algorithm') or LEGACY_ALGORITHM,
+                   data.get('fingerprint'), data.get('device'))
+
+    def to_dict(self, root: Path) -> FileInfo:
+        return {'path': os.path.relpath(os.path.join(self.directory, self.name), root), 'size': self.size,
+                'quickhash': _hex(self._quickhash), 'hash': _hex(self._hash),
+                'mtime': self.mtime, 'ctime': self.ctime, 'inode': self.inode, 'algorithm': self.algorithm,
+                'fingerprint': self._fingerprint, 'device': self.device}
+
+    def digest(self, kind: str) -> Optional[Union[bytes, str]]:
+        """The quickhash, fingerprint or hash if known, in a form only meant for comparing."""
+        return getattr(self, '_' + kind)
+
+    def set_digest(self, kind: str, hexdigest: Optional[str]):
+        setattr(self, '_' + kind, hexdigest if kind == 'fingerprint' else _digest(hexdigest))
+
+    def use_algorithm(self, algorithm: str):
+        """Switch to another hash algorithm, forgetting hashes made with the old one."""
+        if algorithm != self.algorithm:
+            self.algorithm = algorithm
+            self._quickhash = None
+            self._fingerprint = None
+            self._hash = None
 
-    def to_dict(self):
-        return {'path': str(self.path), 'size': self.size, 'quickhash': self.quickhash, 'hash': self.hash if self._hash is not None else None}
+    @property
+    def identity(self) -> Optional[Tuple[int, int]]:
+        """(device, inode) if known, the same for every hard link to a file."""
+        if self.device is None or self.inode is None:
+            return None
+        return self.device, self.inode
+
+    def is_unchanged(self, entry: walker.Entry) -> bool:
+        """True if the file on disk still matches the indexed size, mtime and inode."""
+        return (self.size == entry.size and
+                self.mtime == entry.mtime and
+                self.inode == entry.inode)
 
     @property
     def quickhash(self) -> str:
         if self._quickhash is None:
-            self._quickhash = hashlib.md5()
-            with open(self.path, 'rb') as f:
-                self._quickhash.update(f.read(1024))
-
-        if isinstance(self._quickhash, str):
-            return self._quickhash
-        return self._quickhash.hexdigest()
+            self.set_digest('quickhash', hashing.hash_head(self.path, algorithm=self.algorithm))
+        return _hex(self._quickhash)
 
     @property
-    def hash(self):
-        block_size = 65536
+    def hash(self) -> str:
         if self._hash is None:
-            self._hash = hashlib.md5()
-            with open(self.path, 'rb') as f:
-                fb = f.read(block_size)
-                while len(fb) > 0:
-                    self._hash.update(fb)
-                    fb = f.read(block_size)
-
-        if isinstance(self._hash, str):
-            return self._hash
-        return self._hash.hexdigest()
+            self.set_digest('hash', hashing.hash_file(self.path, self.algorithm))
+        return _hex(self._hash)
 
     def __repr__(self):
         return f'<File {self.path}>'
 
 
+class HashPool:
+    """Compute quickhashes or full hashes for batches of files concurrently.
+
+    hashlib releases the GIL while hashing, so a thread pool keeps several
+    reads and hashes in flight at once. A process pool can be used instead
+    when hashing is CPU bound. Files that can not be read are left out of
+    the returned list.
+    """
+    jobs: int
+    processes: bool
+    files: int
+    bytes_read: int
+    elapsed: float
+    _executor: Optional[Executor]
+
+    def __init__(self, jobs: int = DEFAULT_JOBS, processes: bool = False):
+        self.jobs = max(1, jobs)
+        self.processes = processes
+        self.files = 0
+        self.bytes_read = 0
+        self.elapsed = 0.0
+        self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args: Any):
+        self.close()
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def _map(self, paths: List[str], kind: str, algorithms: List[str],
+             fingerprint_blocks: int) -> Iterator[Tuple[Optional[str], int]]:
+        if self.jobs == 1 or len(paths) < 2:
+            return map(_hash_job, paths, repeat(kind), algorithms, repeat(fingerprint_blocks))
+
+        if self._executor is None:
+            executor_class = ProcessPoolExecutor if self.processes else ThreadPoolExecutor
+            self._executor = executor_class(max_workers=self.jobs)
+
+        chunksize = max(1, len(paths) // (self.jobs * 4)) if self.processes else 1
+        return self._executor.map(_hash_job, paths, repeat(kind), algorithms, repeat(fingerprint_blocks),
+                                  chunksize=chunksize)
+
+    def hash(self, files: Iterable[File], kind: str = 'hash', fingerprint_blocks: int = FINGERPRINT_BLOCKS) -> List[File]:
+        """Fill in the quickhash, fingerprint or hash of files that don't have one yet."""
+        done: List[File] = []
+        todo: List[File] = []
+        for f in files:
+            (todo if f.digest(kind) is None else done).append(f)
+
+        hits = len(done)
+        start = time.perf_counter()
+        total_read = 0
+        for f, (digest, bytes_read) in zip(todo, self._map([str(f.path) for f in todo], kind, [f.algorithm for f in todo],
+                                                                fingerprint_blocks)):
+            total_read += bytes_read
+            if digest is None:
+                continue
+            f.set_digest(kind, digest)
+            self.files += 1
+            done.append(f)
+        elapsed = time.perf_counter() - start
+        self.bytes_read += total_read
+        self.elapsed += elapsed
+        if done or todo:
+            tracker.count(kind, files=hits + len(todo), bytes=total_read, calls=len(todo), hits=hits,
+                          misses=len(todo), busy=elapsed)
+
+        return done
+
+    def report(self) -> str:
+        megabytes = self.bytes_read / (1024 * 1024)
+        rate = megabytes / self.elapsed if self.elapsed > 0 else 0.0
+        return f"Hashed {self.files} file(s), {megabytes:.1f} MB in {self.elapsed:.1f}s ({rate:.1f} MB/s)"
+
+
+def fingerprint_pays_off(size: int, fingerprint_blocks: int = FINGERPRINT_BLOCKS) -> bool:
+    """True if sampling a file of size bytes reads much less than hashing it in full."""
+    return size > 2 * hashing.fingerprint_size(fingerprint_blocks)
+
+
+def distinct_files(files: Iterable[File]) -> int:
+    """Number of files that are not hard links to one another."""
+    return len({f.identity or id(f) for f in files})
+
+
+def identical(groups: List[List[File]], pool: HashPool, fingerprint_blocks: int,
+              write_back: Callable[[Iterable[File]], None],
+              keep: Callable[[List[File]], bool] = lambda files: distinct_files(files) > 1) -> List[List[File]]:
+    """Split groups of files of the same size into groups of files with identical content.
+
+    Files go through quickhash, a fingerprint of blocks sampled over the
+    file, and finally the full hash, where each stage only reads the files
+    in groups that survived the one before. Groups are only kept while keep
+    is true for them, by default while they hold more than hard links to
+    one file. Only one link to a file is read, the others are given its
+    hash. Files that no longer exist are left out. Everything computed is
+    passed to write_back.
+    """
+    def refine(groups: Iterable[List[File]], kind: str) -> List[List[File]]:
+        hard_links: Dict[Tuple[int, int], List[File]] = {}
+        unhashed: List[File] = []
+        known = [f for files in groups for f in files if f.digest(kind) is not None]
+        if known:
+            tracker.count(kind, files=len(known), hits=len(known))
+        for f in (f for files in groups for f in files if f.digest(kind) is None):
+            identity = f.identity
+            if identity is not None and identity in hard_links:
+                hard_links[identity].append(f)
+                continue
+            if identity is not None:
+                hard_links[identity] = []
+            unhashed.append(f)
+
+        hashed = pool.hash(unhashed, kind, fingerprint_blocks)
+        copied = 0
+        for f in [f for f in hashed if f.identity in hard_links]:
+            for link in hard_links[f.identity]:
+                link.set_digest(kind, _hex(f.digest(kind)))
+                hashed.append(link)
+                copied += 1
+        if copied:
+            tracker.count(kind, files=copied, hits=copied)
+        write_back(hashed)
+
+        refined: List[List[File]] = []
+        for files in groups:
+            by_digest: Dict[Union[bytes, str], List[File]] = {}
+            for f in files:
+                digest = f.digest(kind)
+                if digest is not None:
+                    by_digest.setdefault(digest, []).append(f)
+            refined += [same for same in by_digest.values() if keep(same)]
+        return refined
+
+    # Digests may come from the index without the file being opened, so drop the files that are gone.
+    groups = [[f for f in files if os.path.exists(os.path.join(f.directory, f.name))] for files in groups]
+    groups = refine([files for files in groups if keep(files)], 'quickhash')
+
+    # The quickhash already covers the whole of a small file.
+    small_files = [f for files in groups for f in files if f.size <= QUICKHASH_SIZE and f._hash is None]
+    for f in small_files:
+        f._hash = f._quickhash
+    write_back(small_files)
+
+    large = [files for files in groups if fingerprint_pays_off(files[0].size, fingerprint_blocks)]
+    small = [files for files in groups if not fingerprint_pays_off(files[0].size, fingerprint_blocks)]
+    return refine(small + refine(large, 'fingerprint'), 'hash')
+
+
+def read_json_index(filename: Path) -> Iterator[Tuple[str, FileInfo]]:
+    """Yield (path, entry) from a JSON index without holding all of it in memory.
+
+    Files written by export_json have one entry per line and are parsed a
+    line at a time. Anything else, like the indented files older versions
+    wrote, is parsed as a whole. A file that ends before its closing brace
+    raises ValueError.
+    """
+    with atomic.open_text(filename) as f:
+        if f.readline().strip() == "{":
+            entries: List[Tuple[str, FileInfo]] = []
+            for line in f:
+                line = line.strip().rstrip(",")
+                if line == "}":
+                    yield from entries
+                    return
+                try:
+                    entries += json.loads("{" + line + "}").items()
+                except json.JSONDecodeError:
+                    break
+                if len(entries) >= BATCH_SIZE:
+                    yield from entries
+                    entries = []
+            else:
+                raise ValueError(f"{filename} ends before its closing }}, it is incomplete")
+
+    # Not one entry per line.
+    with atomic.open_text(filename) as f:
+        yield from json.load(f).items()
+
+
+def report_line(file_object: File, **fields: Any) -> str:
+    """The JSON Lines line for a file in a report, with its absolute path, size and fields."""
+    return json.dumps({'path': os.path.abspath(file_object.path), 'size': file_object.size, **fields}) + "\n"
+
+
+def read_report(filename: Path) -> Set[str]:
+    """The absolute paths in a report of report_line lines.
+
+    Lines like "<File path>", printed by compare before it wrote reports,
+    are read too.
+    """
+    paths: Set[str] = set()
+    with atomic.open_text(filename) as f:
+        for line in f:
+            if line.startswith("{"):
+                paths.add(json.loads(line)['path'])
+            elif match := re.match('<File (.*)>', line):
+                paths.add(os.path.abspath(match.group(1)))
+    return paths
+
+
+def move_file(source: Union[str, Path], destination: Union[str, Path]) -> bool:
+    """Move source to destination, creating the folders it needs.
+
+    A rename is tried first, which is instant on the same file system, and
+    only when that fails the file is copied. Returns False if source no
+    longer exists.
+    """
+    os.makedirs(os.path.dirname(destination) or ".", exist_ok=True)
+    try:
+        os.rename(source, destination)
+    except FileNotFoundError:
+        return False
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(source, destination)
+    return True
+
+
+class IndexStore:
+    """SQLite storage for a file index, one row per file keyed on its path relative to the index root."""
+    COLUMNS = {
+        'path': 'TEXT PRIMARY KEY',
+        'size': 'INTEGER NOT NULL',
+        'quickhash': 'TEXT',
+        'hash': 'TEXT',
+        'mtime': 'REAL',
+        'ctime': 'REAL',
+        'inode': 'INTEGER',
+        'algorithm': 'TEXT',
+        'fingerprint': 'TEXT',
+        'device': 'INTEGER',
+    }
+    INDEXED = ('size', 'quickhash', 'hash')
+
+    # Open stores by database file, see shared().
+    _shared: 'weakref.WeakValueDictionary[Tuple[int, int], IndexStore]' = weakref.WeakValueDictionary()
+
+    def __init__(self, filename: Path):
+        self.filename = filename
+        self.connection = sqlite3.connect(filename)
+        self.connection.row_factory = sqlite3.Row
+        self._create()
+
+    @classmethod
+    def shared(cls, filename: Path) -> 'IndexStore':
+        """The open store for filename, opening it if there is none.
+
+        Indexes of folders below one root, like the two sides of a compare
+        within one index, write to the same database. Each with a
+        connection of its own, one would wait on the uncommitted writes of
+        the other until the database is locked, so they share one.
+        """
+        if filename.is_file():
+            file_stat = os.stat(filename)
+            existing = cls._shared.get((file_stat.st_dev, file_stat.st_ino))
+            if existing is not None and existing.connection is not None:
+                return existing
+
+        store = cls(filename)
+        file_stat = os.stat(filename)
+        cls._shared[(file_stat.st_dev, file_stat.st_ino)] = store
+        return store
+
+    def _create(self):
+        columns = ", ".join(f"{k} {v}" for k, v in self.COLUMNS.items())
+        self.connection.execute(f"CREATE TABLE IF NOT EXISTS files ({columns})")
+
+        # Add columns introduced after the index was first created.
+        existing = {row['name'] for row in self.connection.execute("PRAGMA table_info(files)")}
+        for name, definition in self.COLUMNS.items():
+            if name not in existing:
+                self.connection.execute(f"ALTER TABLE files ADD COLUMN {name} {definition}")
+
+        for name in self.INDEXED:
+            self.connection.execute(f"CREATE INDEX IF NOT EXISTS files_{name} ON files ({name})")
+        self.connection.commit()
+
+    def upsert(self, data: FileInfo):
+        names = ", ".join(data.keys())
+        values = ", ".join("?" for _ in data)
+        self.connection.execute(f"INSERT OR REPLACE INTO files ({names}) VALUES ({values})", tuple(data.values()))
+
+    def update_hashes(self, rows: Iterable[Tuple[Optional[str], Optional[str], Optional[str], str, str]]):
+        """Set quickhash, fingerprint, hash and algorithm for existing paths."""
+        self.connection.executemany(
+            "UPDATE files SET quickhash = ?, fingerprint = ?, hash = ?, algorithm = ? WHERE path = ?", rows)
+
+    def set_device(self, key: str, device: int):
+        self.connection.execute("UPDATE files SET device = ? WHERE path = ?", (device, key))
+
+    def delete(self, key: str):
+        self.connection.execute("DELETE FROM files WHERE path = ?", (key, ))
+
+    def clear(self):
+        self.connection.execute("DELETE FROM files")
+
+    def get(self, key: str) -> Optional[sqlite3.Row]:
+        return self.connection.execute("SELECT * FROM files WHERE path = ?", (key, )).fetchone()
+
+    def rows(self, where: str = "", params: Tuple[Any, ...] = (), order_by: str = "path") -> Iterator[sqlite3.Row]:
+        query = "SELECT * FROM files"
+        if where:
+            query += f" WHERE {where}"
+        query += f" ORDER BY {order_by}"
+        return self.connection.execute(query, params)
+
+    def keys(self, where: str = "", params: Tuple[Any, ...] = ()) -> Iterator[str]:
+        query = "SELECT path FROM files"
+        if where:
+            query += f" WHERE {where}"
+        for row in self.connection.execute(query, params):
+            yield row['path']
+
+    def size_counts(self, where: str = "", params: Tuple[Any, ...] = ()) -> Iterator[Tuple[int, int]]:
+        """Yield (size, number of files) in order of size."""
+        query = "SELECT size, COUNT(*) AS count FROM files"
+        if where:
+            query += f" WHERE {where}"
+        query += " GROUP BY size ORDER BY size"
+        for row in self.connection.execute(query, params):
+            yield row['size'], row['count']
+
+    def total_size(self, where: str = "", params: Tuple[Any, ...] = ()) -> int:
+        query = "SELECT TOTAL(size) FROM files"
+        if where:
+            query += f" WHERE {where}"
+        return int(self.connection.execute(query, params).fetchone()[0])
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+        self.connection = None
+
+
 class FileIndex:
     path: Path
-    _index: Dict[str, File]
+    algorithm: str
+    fingerprint_blocks: int
+    _store: Optional[IndexStore]
     _index_path: Path
+    _view: Optional[Dict[str, File]]
+    _unsaved: int
+    _saved_at: float
+    log: Callable[[str], None]
 
-    def __init__(self, path: Path = Path(".")):
+    def __init__(self, path: Path = Path("."), algorithm: str = DEFAULT_ALGORITHM,
+                 fingerprint_blocks: int = FINGERPRINT_BLOCKS):
         self.path = path
-        self._index = {}
+        self.algorithm = algorithm
+        self.fingerprint_blocks = fingerprint_blocks
+        self._store = None
+        self._index_path = path / INDEX_DB_NAME
+        self._view = None
+        self._unsaved = 0
+        self._saved_at = time.monotonic()
+        # Where progress messages go.
+        self.log = print
+
+    @property
+    def root(self) -> Path:
+        return self._index_path.parent
+
+    @property
+    def store(self) -> IndexStore:
+        if self._store is None:
+            raise IndexError("No fileindex loaded.")
+        return self._store
+
+    def _open(self, folder: Path):
+        """Open the index database in folder, migrating a JSON index found there."""
+        self._index_path = folder / INDEX_DB_NAME
+        self._view = None
+        if not self._index_path.is_file() and (folder / INDEX_FILE_NAME).is_file():
+            self.log(f"Migrating {folder / INDEX_FILE_NAME} to {self._index_path}")
+            # Imported into a temporary database first, so a failed import is retried on the next run.
+            migrating = folder / f"{INDEX_DB_NAME}.migrating"
+            migrating.unlink(missing_ok=True)
+            self._store = IndexStore(migrating)
+            try:
+                self.import_json(folder / INDEX_FILE_NAME)
+                self.save()
+            except BaseException:
+                self._store.close()
+                self._store = None
+                migrating.unlink()
+                raise
+            self._store.close()
+            os.replace(migrating, self._index_path)
+        self._store = IndexStore.shared(self._index_path)
 
     def load(self, go_upwards: bool = True):
-        filename = self.path / INDEX_FILE_NAME
+        def has_index(folder: Path):
+            return (folder / INDEX_DB_NAME).is_file() or (folder / INDEX_FILE_NAME).is_file()
+
+        folder = self.path
 
-        if not filename.is_file() and go_upwards and str(self.path.absolute()) != self.path.root:
+        if not has_index(folder) and go_upwards and str(self.path.absolute()) != self.path.root:
             parent = self.path.absolute()
-            while str(parent) != parent.root and not (parent / INDEX_FILE_NAME).is_file():
+            while str(parent) != parent.root and not has_index(parent):
                 parent = parent.parent
-                filename = parent / INDEX_FILE_NAME
+            folder = parent
 
-        if not filename.is_file():
+        if not has_index(folder):
             raise IndexError("No fileindex found.")
 
-        with open(filename, encoding="utf8") as f:
-            t_index = json.load(f)
-            self._index_path = filename
-
-            self._index = {}
-            for k, v in t_index.items():
-                self._index[k] = File.from_dict(
-                    v, parent=self._index_path.parent)
-
-    def update(self):
-        cwd = Path.cwd()
-        os.chdir(self.path)
-        for root, _, files in os.walk('.'):
-            print(f"Checking {len(files)} file(s) in folder: {root}")
-            r = Path(root)
-            for filename in files:
-                path = r / filename
-                if not path.is_file():
+        self._open(folder)
+
+    def import_json(self, filename: Path):
+        """Add the entries of a JSON index, as written by export_json or older versions of this script."""
+        for k, v in read_json_index(filename):
+            v['path'] = k
+            self.add_file(File.from_dict(v, parent=self.root))
+
+    def export_json(self, filename: Path):
+        """Write the indexed files below self.path as JSON, one entry per line.
+
+        The entries are streamed from the database, to a temporary file that
+        replaces filename once complete. Names ending in .gz or .zst are
+        compressed.
+        """
+        with atomic.atomic_write(filename) as f:
+            f.write("{\n")
+            first = True
+            for row in self._rows():
+                if not first:
+                    f.write(",\n")
+                first = False
+                data = self._file(row).to_dict(self.root)
+                f.write(f"{json.dumps(row['path'])}: {json.dumps(data, separators=(',', ':'))}")
+            f.write("\n}\n")
+
+    def update(self, incremental: bool = False, pool: Optional[HashPool] = None, stat_only: bool = False,
+               walk_jobs: int = walker.DEFAULT_JOBS):
+        """Walk the folder and index every file in it.
+
+        With incremental set, entries in an existing index whose size, mtime
+        and inode are unchanged are kept as-is, so only new and modified files
+        are read. Paths that no longer exist are dropped. New files are
+        quickhashed in batches on pool, unless stat_only is set, in which case
+        no file is opened and hashes are left to be computed when needed.
+        The tree is walked with walk_jobs threads.
+        """
+        pool = None if stat_only else pool or HashPool(1)
+        self._open(self.path)
+        if not incremental:
+            self.store.clear()
+
+        reused, indexed, dropped = self._sync(str(self.path), pool, walk_jobs)
+        if incremental:
+            self.log(f"Reused {reused} unchanged, indexed {indexed} new or modified, dropped {dropped} missing file(s).")
+
+    def _sync(self, folder: str, pool: Optional[HashPool], walk_jobs: int = walker.DEFAULT_JOBS) -> Tuple[int, int, int]:
+        """Walk folder, index new and modified files in it and drop the entries of files no longer there.
+
+        Returns how many files were unchanged, indexed and dropped.
+        """
+        seen = set()
+        reused = 0
+        pending: List[File] = []
+        prefix = os.path.join(self.path, "")
+        for root, files in walker.walk(folder, [INDEX_FILE_PREFIX + "*"], walk_jobs):
+            self.log(f"Checking {len(files)} file(s) in folder: {root}")
+            reused_before = reused
+            for entry in files:
+                key = entry.path[len(prefix):]
+                seen.add(key)
+                if self._is_current(key, entry):
+                    reused += 1
                     continue
 
-                file_object = File(path)
+                pending.append(File.from_entry(entry, self.algorithm))
+                if len(pending) >= BATCH_SIZE:
+                    self._add_hashed(pending, pool)
+                    pending = []
+            tracker.count('stat', hits=reused - reused_before, misses=len(files) - (reused - reused_before))
+
+        self._add_hashed(pending, pool)
+
+        dropped = 0
+        where, params = self._folder_range(folder[len(prefix):])
+        for key in [k for k in self.store.keys(where, params) if k not in seen]:
+            self.store.delete(key)
+            dropped += 1
+        if dropped:
+            self._view = None
+        return reused, len(seen) - reused, dropped
+
+    def _is_current(self, key: str, entry: walker.Entry) -> bool:
+        """True if the index has key, hashed with our algorithm, and entry shows the file is unchanged."""
+        known = self.store.get(key)
+        if (known is None or (known['algorithm'] or LEGACY_ALGORITHM) != self.algorithm or
+                not self._file(known).is_unchanged(entry)):
+            return False
+        # Entries from before the device was recorded.
+        if known['device'] is None:
+            self.store.set_device(key, entry.device)
+        return True
+
+    def apply_changes(self, paths: Iterable[str], pool: Optional[HashPool] = None,
+                      walk_jobs: int = walker.DEFAULT_JOBS) -> Tuple[int, int]:
+        """Bring the entries for paths below the index folder up to date with what is on disk.
+
+        Each path is stat'ed: files are indexed if new or modified, and
+        directories are walked, so moving a tree in is one path. Entries for
+        a path that no longer exists, and for anything below it, are dropped.
+        Returns how many files were indexed and dropped.
+        """
+        pool = pool or HashPool(1)
+        prefix = os.path.join(self.path, "")
+        indexed = 0
+        dropped = 0
+        pending: List[File] = []
+        for path in sorted(paths):
+            if path != str(self.path) and not path.startswith(prefix):
+                continue
+            key = path[len(prefix):]
+            if os.path.basename(path).startswith(INDEX_FILE_PREFIX):
+                continue
 
-                self.add_file(file_object)
-        os.chdir(cwd)
-        print(Path.cwd())
+            # As the walker does: symbolic links to files are indexed as the file, links to directories are not entered.
+            try:
+                file_stat = os.stat(path, follow_symlinks=False)
+                if not stat.S_ISDIR(file_stat.st_mode):
+                    file_stat = os.stat(path)
+                    if stat.S_ISDIR(file_stat.st_mode):
+                        file_stat = None
+            except OSError:
+                file_stat = None
+
+            if file_stat is not None and stat.S_ISDIR(file_stat.st_mode):
+                _, new, gone = self._sync(path, pool, walk_jobs)
+                indexed += new
+                dropped += gone
+            elif file_stat is not None and stat.S_ISREG(file_stat.st_mode):
+                entry = walker.Entry(path, os.path.basename(path), file_stat.st_size, file_stat.st_mtime,
+                                     file_stat.st_ctime, file_stat.st_ino, file_stat.st_dev)
+                if not self._is_current(key, entry):
+                    pending.append(File.from_entry(entry, self.algorithm))
+            else:
+                where, params = self._folder_range(key)
+                for gone_key in [key, *self.store.keys(where, params)]:
+                    if self.store.get(gone_key) is not None:
+                        self.store.delete(gone_key)
+                        dropped += 1
+                self._view = None
+
+        self._add_hashed(pending, pool)
+        return indexed + len(pending), dropped
+
+    def _add_hashed(self, files: List[File], pool: Optional[HashPool]):
+        if pool is not None:
+            files = pool.hash(files, 'quickhash')
+        for file_object in files:
+            self.add_file(file_object)
+
+    def _key(self, file_object: File) -> str:
+        return str(file_object.path.relative_to(self.root))
+
+    def _file(self, row: sqlite3.Row) -> File:
+        file_object = File.from_dict(dict(row), parent=self.root)
+        # Never compare hashes made with different algorithms or samples.
+        file_object.use_algorithm(self.algorithm)
+        if file_object._fingerprint is not None and not file_object._fingerprint.startswith(f"{self.fingerprint_blocks}:"):
+            file_object._fingerprint = None
+        return file_object
+
+    def _fingerprint_pays_off(self, size: int) -> bool:
+        return fingerprint_pays_off(size, self.fingerprint_blocks)
+
+    def _scope(self) -> Tuple[str, Tuple[Any, ...]]:
+        """SQL condition limiting a query to the files below self.path.
+
+        The paths are the primary key, so a range on them is a prefix lookup
+        in the index instead of a filter over every entry.
+        """
+        return self._folder_range(str(self.path.absolute().relative_to(self.root.absolute())))
+
+    @staticmethod
+    def _folder_range(folder: str) -> Tuple[str, Tuple[Any, ...]]:
+        """SQL condition matching the paths below folder, given relative to the index root."""
+        if folder in ("", "."):
+            return "", ()
+        # '0' is the character after '/', so this covers everything in the folder.
+        return "path >= ? AND path < ?", (f"{folder}/", f"{folder}0")
+
+    def _rows(self, where: str = "", params: Tuple[Any, ...] = (), order_by: str = "path") -> Iterator[sqlite3.Row]:
+        scope, scope_params = self._scope()
+        if scope:
+            where = f"{scope} AND ({where})" if where else scope
+            params = scope_params + params
+
+        return self.store.rows(where, params, order_by)
+
+    def _files(self, where: str = "", params: Tuple[Any, ...] = (), order_by: str = "path") -> Iterator[File]:
+        for row in self._rows(where, params, order_by):
+            yield self._file(row)
 
     def add_file(self, file_object: File):
         # print(f"Adding: {file_object.path}")
-        self._index[str(file_object.path)] = file_object
+        self.store.upsert(file_object.to_dict(self.root))
+        self._view = None
 
     def remove_file(self, file_object: File):
-        if str(file_object.path) in self._index:
-            print(f"Removing {file_object.path}")
-            del self._index[str(file_object.path)]
+        key = self._key(file_object)
+        if self.store.get(key) is not None:
+            self.log(f"Removing {file_object.path}")
+            self.store.delete(key)
+            self._view = None
+
+    def write_back(self, files: Iterable[File]):
+        """Store hashes computed for already indexed files.
+
+        Commits every WRITE_BACK_FILES files or WRITE_BACK_SECONDS seconds.
+        Each commit is a transaction, so an interrupted run keeps everything
+        written back up to its last commit and the index is never left half
+        written.
+        """
+        rows = [(_hex(f._quickhash), f._fingerprint, _hex(f._hash), f.algorithm, self._key(f)) for f in files]
+        if not rows:
+            return
+
+        self.store.update_hashes(rows)
+        self._view = None
+        self._unsaved += len(rows)
+        if self._unsaved >= WRITE_BACK_FILES or time.monotonic() - self._saved_at >= WRITE_BACK_SECONDS:
+            self.save()
 
     def save(self):
-        with open(self.path / INDEX_FILE_NAME, 'w') as f:
-            json.dump(self._index, f, cls=JsonEncoder, indent=4)
+        if self._store is not None:
+            with tracker.timed('save', files=1, calls=1):
+                self.store.commit()
+        self._unsaved = 0
+        self._saved_at = time.monotonic()
 
     @property
-    def index(self):
-        def path_filter(x: Tuple[Any, File]):
-            _, v = x
-            full_path = self._index_path.parent / v.path
-            if full_path.absolute().is_relative_to(self.path.absolute()):
-                return True
+    def index(self) -> Dict[str, File]:
+        """The indexed files below self.path, kept until the index is changed."""
+        if self._view is None:
+            self._view = {row['path']: self._file(row) for row in self._rows()}
+        return self._view
+
+    def by_size(self) -> Dict[int, List[File]]:
+        """The indexed files below self.path grouped on size, smallest first."""
+        return {size: [f for f in files] for size, files in groupby(self._files(order_by="size, path"),
+                                                                       key=lambda f: f.size)}
+
+    def by_hash(self, pool: Optional[HashPool] = None) -> Dict[str, List[File]]:
+        """The indexed files below self.path grouped on quickhash.
+
+        Missing quickhashes are computed on pool a batch at a time and
+        written back first. Files that can not be read are left out.
+        """
+        pool = pool or HashPool(1)
+        valid, params = "COALESCE(algorithm, ?) = ?", (LEGACY_ALGORITHM, self.algorithm)
+        missing = [f for f in self._files(f"quickhash IS NULL OR NOT {valid}", params)]
+        for batch in batched(missing):
+            self.write_back(pool.hash(batch, 'quickhash'))
+        del missing
+
+        files = self._files(f"quickhash IS NOT NULL AND {valid}", params, order_by="quickhash, path")
+        return {_hex(digest): [f for f in same] for digest, same in groupby(files, key=lambda f: f._quickhash)}
+
+    def size_counts(self, min_size: int = 0) -> Dict[int, int]:
+        """Number of files of each size of at least min_size."""
+        return {size: count for size, count in self.iter_size_counts(min_size)}
+
+    def iter_size_counts(self, min_size: int = 0) -> Iterator[Tuple[int, int]]:
+        """Yield (size, number of files) for each size of at least min_size, smallest first."""
+        return self.store.size_counts(*self._min_size(min_size))
+
+    def total_size(self, min_size: int = 0) -> int:
+        """Bytes in the files of at least min_size."""
+        return self.store.total_size(*self._min_size(min_size))
+
+    def _min_size(self, min_size: int) -> Tuple[str, Tuple[Any, ...]]:
+        scope, params = self._scope()
+        where = f"{scope} AND size >= ?" if scope else "size >= ?"
+        return where, params + (min_size, )
+
+    def with_sizes(self, sizes: List[int]) -> List[File]:
+        files: List[File] = []
+        for batch in batched(sizes, MAX_QUERY_PARAMETERS):
+            files += self._files(f"size IN ({', '.join('?' for _ in batch)})", tuple(batch))
+        return files
+
+    def with_size(self, size: int) -> List[File]:
+        return [f for f in self._files("size = ?", (size, ))]
+
+    def size_collisions(self, min_size: int = 0) -> Iterator[Tuple[int, List[File]]]:
+        """Yield (size, files) for every size of at least min_size shared by more than one file below self.path.
+
+        The files are loaded for batches of sizes, of up to about BATCH_SIZE
+        files each, instead of one query per size.
+        """
+        collisions = [(size, count) for size, count in self.iter_size_counts(min_size) if count > 1]
+        batch: List[int] = []
+        count = 0
+        for i, (size, n) in enumerate(collisions):
+            batch.append(size)
+            count += n
+            if count >= BATCH_SIZE or len(batch) >= MAX_QUERY_PARAMETERS or i == len(collisions) - 1:
+                by_size: Dict[int, List[File]] = {}
+                for f in self.with_sizes(batch):
+                    by_size.setdefault(f.size, []).append(f)
+                for size in batch:
+                    yield size, by_size[size]
+                batch, count = [], 0
+
+    def duplicates(self, pool: Optional[HashPool] = None, min_size: int = 1) -> Iterator[List[File]]:
+        """Yield groups of files with identical content.
+
+        Files sharing a size are checked by identical() a batch at a time, so
+        only one batch of size groups is held in memory. Everything computed
+        is written back to the index.
+        """
+        pool = pool or HashPool(1)
+        tracker.phase('quickhash').total = sum(count for count in self.size_counts(min_size).values() if count > 1)
+        for batch in self._size_batches(min_size):
+            yield from identical(batch, pool, self.fingerprint_blocks, self.write_back)
+
+    def link_duplicates(self, files: List[File], method: str, dry_run: bool = False) -> int:
+        """Replace identical files by links to one of them, returning the bytes reclaimed.
+
+        The file kept is the one with the most hard links in the group, and
+        files already linked to it are left alone. method is one of
+        links.METHODS. Files on another device than the one kept can not be
+        linked and are skipped, and so are files that changed since they
+        were indexed. Before linking, the files are hashed again, as their
+        hashes may come from the index.
+        """
+        links_to: Dict[Any, int] = {}
+        for f in files:
+            links_to[f.identity or id(f)] = links_to.get(f.identity or id(f), 0) + 1
+        keeper = min(files, key=lambda f: (-links_to[f.identity or id(f)], str(f.path)))
+        if not self._still_identical(keeper, keeper.hash, rehash=not dry_run):
+            return 0
+
+        reclaimed = set()
+        for f in files:
+            if f is keeper or (f.identity is not None and f.identity == keeper.identity):
+                continue
+            if f.device is not None and keeper.device is not None and f.device != keeper.device:
+                self.log(f"Skipping {f.path}, it is on another device than {keeper.path}")
+                continue
+            if not self._still_identical(f, keeper.hash, rehash=not dry_run):
+                continue
+
+            self.log(f"Linking {f.path} to {keeper.path}")
+            if not dry_run:
+                try:
+                    links.link(keeper.path, f.path, method)
+                except OSError as e:
+                    self.log(f"Could not link {f.path}: {e}")
+                    continue
+                file_stat = os.stat(f.path)
+                f.mtime, f.ctime, f.inode, f.device = (file_stat.st_mtime, file_stat.st_ctime, file_stat.st_ino,
+                                                       file_stat.st_dev)
+                self.add_file(f)
+            reclaimed.add(f.identity or id(f))
+
+        return len(reclaimed) * keeper.size
+
+    def _still_identical(self, f: File, digest: str, rehash: bool) -> bool:
+        """True if f is on disk as indexed and, with rehash, its content still hashes to digest."""
+        try:
+            file_stat = os.stat(f.path)
+            entry = walker.Entry(str(f.path), f.name, file_stat.st_size, file_stat.st_mtime, file_stat.st_ctime,
+                                 file_stat.st_ino, file_stat.st_dev)
+            if not f.is_unchanged(entry) or (rehash and hashing.hash_file(f.path, f.algorithm) != digest):
+                self.log(f"Skipping {f.path}, it changed since it was indexed")
+                return False
+        except OSError as e:
+            self.log(f"Skipping {f.path}, it can not be read: {e}")
             return False
-        return dict(filter(path_filter, self._index.items()))
+        return True
+
+    def _size_batches(self, min_size: int) -> Iterator[List[List[File]]]:
+        """Size groups batched up to about BATCH_SIZE files, so the hash pool has enough work."""
+        batch: List[List[File]] = []
+        count = 0
+        for _, files in self.size_collisions(min_size):
+            batch.append(files)
+            count += len(files)
+            if count >= BATCH_SIZE:
+                yield batch
+                batch, count = [], 0
+        if batch:
+            yield batch
+
+    def missing_from(self, other: 'FileIndex', pool: Optional[HashPool] = None, min_size: int = 0) -> List[File]:
+        """Files in this index of at least min_size bytes with no identical file in other, in order of path."""
+        return sorted(self.iter_missing_from(other, pool, min_size), key=lambda f: f.path)
+
+    def iter_missing_from(self, other: 'FileIndex', pool: Optional[HashPool] = None,
+                          min_size: int = 0) -> Iterator[File]:
+        """Yield the files in this index of at least min_size bytes with no identical file in other, as found.
+
+        Works as a join on (size, digest) keys, one tier at a time: files are
+        matched on size from the size counts alone, then quickhash,
+        fingerprint and full hash. Each tier hashes every surviving file on
+        either side once, and drops the files whose key has no counterpart on
+        the other side. Computed hashes are written back to both indexes.
+        """
+        pool = pool or HashPool(1)
+        self.log("Loading source index")
+        self.load()
+        self.log("Loading destination index")
+        other.load()
 
-    def by_size(self):
-        by_size: Dict[int, List[File]] = {}
-        for _, v in self.index.items():
-            if v.size not in by_size:
-                by_size[v.size] = []
+        self.log("Comparing files.")
+        my_sizes = self.size_counts(min_size)
+        other_sizes = other.size_counts(min_size)
+        without_match = [size for size in my_sizes if size not in other_sizes]
+        for batch in batched(without_match, MAX_QUERY_PARAMETERS):
+            for my_file in self.with_sizes(batch):
+                self.log(f"Missing file: {my_file}")
+                yield my_file
+
+        for sizes in self._join_batches(my_sizes, other_sizes):
+            mine = self.with_sizes(sizes)
+            theirs = other.with_sizes(sizes)
+            for kind in ('quickhash', 'fingerprint', 'hash'):
+                key = partial(self._join_key, kind=kind)
+                my_unhashed = [f for f in mine if key(f)[1] is None]
+                their_unhashed = [f for f in theirs if key(f)[1] is None]
+                pool.hash(my_unhashed + their_unhashed, kind, self.fingerprint_blocks)
+                self.write_back(f for f in my_unhashed if key(f)[1] is not None)
+                other.write_back(f for f in their_unhashed if key(f)[1] is not None)
+
+                their_keys = {key(f) for f in theirs if key(f)[1] is not None}
+                for my_file in mine:
+                    if key(my_file) not in their_keys:
+                        self.log(f"Missing file: {my_file}")
+                        yield my_file
+
+                mine = [f for f in mine if key(f) in their_keys]
+                my_keys = {key(f) for f in mine}
+                theirs = [f for f in theirs if key(f) in my_keys]
+
+    def _join_key(self, f: File, kind: str) -> Tuple[int, Optional[Union[bytes, str]]]:
+        if kind == 'fingerprint' and not self._fingerprint_pays_off(f.size):
+            return f.size, ''
+        return f.size, f.digest(kind)
+
+    def _join_batches(self, my_sizes: Dict[int, int], other_sizes: Dict[int, int]) -> Iterator[List[int]]:
+        """Sizes found on both sides, batched up to about BATCH_SIZE files."""
+        batch: List[int] = []
+        count = 0
+        for size in sorted(my_sizes):
+            if size not in other_sizes:
+                continue
+            batch.append(size)
+            count += my_sizes[size] + other_sizes[size]
+            if count >= BATCH_SIZE or len(batch) >= MAX_QUERY_PARAMETERS:
+                yield batch
+                batch, count = [], 0
+        if batch:
+            yield batch
+
+
+class IndexSet:
+    """Several file indexes, like those of a set of backup volumes, searched as one.
+
+    Nothing is copied out of the indexes. The size counts of each index are
+    read in order of size and merged, and only the files of a batch of sizes
+    found in more than one index are loaded at a time. All indexes must be
+    hashed with the same algorithm and fingerprint for hashes to be reused.
+    """
+    indexes: List[FileIndex]
+
+    def __init__(self, folders: Iterable[Path], algorithm: str = DEFAULT_ALGORITHM,
+                 fingerprint_blocks: int = FINGERPRINT_BLOCKS):
+        self.indexes = [FileIndex(folder, algorithm, fingerprint_blocks) for folder in folders]
+        self.fingerprint_blocks = fingerprint_blocks
+
+    def load(self):
+        for index in self.indexes:
+            index.load()
 
-            by_size[v.size].append(v)
+    def save(self):
+        for index in self.indexes:
+            if index._store is not None:
+                index.save()
+
+    def shared_sizes(self, min_size: int = 1) -> Iterator[Tuple[int, Dict[int, int]]]:
+        """Yield (size, {index number: files}) for sizes of at least min_size found in more than one index."""
+        streams = [zip(index.iter_size_counts(min_size), repeat(number)) for number, index in enumerate(self.indexes)]
+        current: Optional[int] = None
+        counts: Dict[int, int] = {}
+        for (size, count), number in heapq.merge(*streams):
+            if size != current:
+                if len(counts) > 1:
+                    yield current, counts
+                current, counts = size, {}
+            counts[number] = count
+        if len(counts) > 1:
+            yield current, counts
+
+    def duplicates(self, pool: Optional[HashPool] = None, min_size: int = 1) -> Iterator[List[Tuple[FileIndex, File]]]:
+        """Yield groups of identical files found in more than one of the indexes, as (index, file) pairs.
+
+        Groups are narrowed down like FileIndex.duplicates, except that a group
+        is dropped as soon as all its files are in the same index. Hashes
+        computed are written back to the index each file belongs to.
+        """
+        pool = pool or HashPool(1)
+        for sizes in self._size_batches(min_size):
+            owners: Dict[int, FileIndex] = {}
+            by_size: Dict[int, List[File]] = {}
+            for index in self.indexes:
+                for f in index.with_sizes(sizes):
+                    owners[id(f)] = index
+                    by_size.setdefault(f.size, []).append(f)
+
+            def write_back(files: Iterable[File]):
+                by_owner: Dict[int, List[File]] = {}
+                for f in files:
+                    by_owner.setdefault(id(owners[id(f)]), []).append(f)
+                for index in self.indexes:
+                    index.write_back(by_owner.get(id(index), []))
+
+            def across_indexes(files: List[File]) -> bool:
+                return len({id(owners[id(f)]) for f in files}) > 1
+
+            for files in identical([files for files in by_size.values()], pool, self.fingerprint_blocks,
+                                   write_back, across_indexes):
+                yield [(owners[id(f)], f) for f in files]
+
+    def _size_batches(self, min_size: int) -> Iterator[List[int]]:
+        """Shared sizes, batched up to about BATCH_SIZE files."""
+        batch: List[int] = []
+        count = 0
+        for size, counts in self.shared_sizes(min_size):
+            batch.append(size)
+            count += sum(counts.values())
+            if count >= BATCH_SIZE or len(batch) >= MAX_QUERY_PARAMETERS:
+                yield batch
+                batch, count = [], 0
+        if batch:
+            yield batch
+
+
+class Output:
+    """Results of a command, written to stdout as they are produced.
+
+    In the text format results and progress messages are printed as they
+    always were. The other formats write one record per file, as JSON
+    Lines, CSV with a header taken from the first record, or paths ending
+    in NUL for xargs -0, and send messages to stderr. Messages are dropped
+    with quiet set.
+    """
+    FORMATS = ('text', 'jsonl', 'csv', 'null')
+
+    def __init__(self, format: str = 'text', quiet: bool = False):
+        self.format = format
+        self.quiet = quiet
+        self._csv: Optional[csv.DictWriter] = None
+
+    def message(self, text: str):
+        if not self.quiet:
+            click.echo(text, err=self.format != 'text')
+
+    def record(self, record: Dict[str, Any], text: Optional[str] = None):
+        """Write record, or text in the text format if given."""
+        if self.format == 'text':
+            sys.stdout.write(f"{record['path'] if text is None else text}\n")
+        elif self.format == 'jsonl':
+            sys.stdout.write(json.dumps(record) + "\n")
+        elif self.format == 'csv':
+            if self._csv is None:
+                self._csv = csv.DictWriter(sys.stdout, fieldnames=[k for k in record])
+                self._csv.writeheader()
+            self._csv.writerow(record)
+        else:
+            sys.stdout.write(f"{record['path']}\0")
 
-        return by_size
+    def file(self, f: File, text: Optional[str] = None, **fields: Any):
+        """Write a record for f, with fields added."""
+        self.record({**fields, 'path': str(f.path), 'size': f.size, 'quickhash': _hex(f._quickhash),
+                     'hash': _hex(f._hash)}, text)
 
-    def by_hash(self):
-        by_hash: Dict[str, List[File]] = {}
 
-        for _, v in self.index.items():
-            if v.quickhash not in by_hash:
-                by_hash[v.quickhash] = []
+@click.group()
+@click.option("--progress", is_flag=True, envvar="PROGRESS",
+              help="Show files and bytes per second, hit rates and time left on stderr.")
+@click.option("--stats", type=click.Path(dir_okay=False), envvar="PROGRESS_STATS",
+              help="Write a JSON summary of the time spent in each phase to this file at exit.")
+def cli(progress: bool = False, stats: Optional[str] = None):
+    tracker.live = progress
+    tracker.stats = stats
 
-            by_hash[v.quickhash].append(v)
 
-        return by_hash
+def pool_options(f: Any):
+    f = click.option("--jobs", "-j", type=int, default=DEFAULT_JOBS, show_default=True,
+                     help="Number of files to hash concurrently.")(f)
+    f = click.option("--processes", is_flag=True, help="Hash in worker processes instead of threads.")(f)
+    return f
 
-    def missing_from(self, other: 'FileIndex') -> List[File]:
-        print("Loading destination index")
-        self.load()
-        print("Loading source index")
-        other.load()
 
-        print("Getting source files by size")
-        other_sizes = other.by_size()
+def fingerprint_option(f: Any):
+    return click.option("--fingerprint-blocks", type=int, default=FINGERPRINT_BLOCKS, show_default=True,
+                        help="Blocks sampled between the first and last block before hashing large files in full.")(f)
 
-        missing: List[File] = []
 
-        print("Comparing files.")
-        for _, my_file in self.index.items():
-            found = False
-            if not my_file.size in other_sizes:
-                missing.append(my_file)
-                print("Missing file: ", my_file)
-                continue
+def quiet_option(f: Any):
+    return click.option("--quiet", "-q", is_flag=True, help="Do not print progress messages.")(f)
 
-            same_size = other_sizes[my_file.size]
-            for s in same_size:
-                if s.quickhash != my_file.quickhash:
-                    continue
 
-                if s.hash == my_file.hash:
-                    found = True
-                    break
+def output_options(f: Any):
+    f = click.option("--format", "output_format", type=click.Choice(Output.FORMATS), default='text', show_default=True,
+                     help="Write one record per file as JSON Lines, CSV or NUL separated paths. "
+                          "Progress messages go to stderr.")(f)
+    return quiet_option(f)
 
-            if not found:
-                print("Missing file: ", my_file)
-                missing.append(my_file)
 
-        return missing
+def algorithm_option(f: Any):
+    return click.option("--algorithm", type=click.Choice([k for k in hashing.ALGORITHMS]), default=DEFAULT_ALGORITHM,
+                        show_default=True, help="Hash algorithm. Entries hashed with another algorithm are rehashed.")(f)
 
 
-@click.group()
-def cli():
-    pass
+@cli.command()
+@click.argument('folder', type=click.Path(path_type=Path, file_okay=False, exists=True))
+@click.option("--full", is_flag=True, help="Rebuild from scratch instead of reusing unchanged entries.")
+@click.option("--stat-only", is_flag=True, help="Only stat files, hash them later when sizes collide.")
+@pool_options
+@algorithm_option
+@quiet_option
+def create(folder: Path, full: bool = False, stat_only: bool = False, jobs: int = DEFAULT_JOBS, processes: bool = False,
+           algorithm: str = DEFAULT_ALGORITHM, quiet: bool = False):
+    """Create or update the file index for FOLDER."""
+    output = Output(quiet=quiet)
+    index = FileIndex(folder, algorithm)
+    index.log = output.message
+    with HashPool(jobs, processes) as pool:
+        index.update(incremental=not full, pool=pool, stat_only=stat_only, walk_jobs=jobs)
+    index.save()
+    output.message(pool.report())
 
 
 @cli.command()
 @click.argument('folder', type=click.Path(path_type=Path, file_okay=False, exists=True))
-def create(folder: Path):
-    """Create a file index for FOLDER."""
-    index = FileIndex(folder)
-    index.update()
-    index.save()
+@click.option("--delay", type=float, default=watcher.DELAY, show_default=True,
+              help="Seconds without changes before a burst of changes is applied.")
+@click.option("--poll-interval", type=float, default=watcher.POLL_INTERVAL, show_default=True,
+              help="Seconds between walks of FOLDER where inotify is not available.")
+@pool_options
+@algorithm_option
+@quiet_option
+def watch(folder: Path, delay: float = watcher.DELAY, poll_interval: float = watcher.POLL_INTERVAL,
+          jobs: int = DEFAULT_JOBS, processes: bool = False, algorithm: str = DEFAULT_ALGORITHM, quiet: bool = False):
+    """Keep the file index for FOLDER up to date as files change, until interrupted."""
+    output = Output(quiet=quiet)
+    index = FileIndex(folder, algorithm)
+    index.log = output.message
+    # Watching starts before the first walk, so what changes during it is applied right after.
+    changes = watcher.changes(folder, [INDEX_FILE_PREFIX + "*"], delay, poll_interval, jobs)
+    with HashPool(jobs, processes) as pool:
+        index.update(incremental=True, pool=pool, walk_jobs=jobs)
+        index.save()
+        output.message(f"Watching {folder}")
+        try:
+            for changed in changes:
+                indexed, dropped = index.apply_changes(changed, pool, jobs)
+                index.save()
+                output.message(f"Indexed {indexed}, dropped {dropped} file(s) for {len(changed)} change(s).")
+        except KeyboardInterrupt:
+            pass
+        finally:
+            index.save()
+    output.message(pool.report())
 
 
 @cli.command()
 @click.argument('folder', type=click.Path(path_type=Path, file_okay=False, exists=True))
 @click.option("--by-size", is_flag=True)
 @click.option("--by-hash", is_flag=True)
-def list(folder: Path, by_size: bool = False, by_hash: bool = False):
+@pool_options
+@algorithm_option
+@output_options
+def list(folder: Path, by_size: bool = False, by_hash: bool = False, jobs: int = DEFAULT_JOBS, processes: bool = False,
+         algorithm: str = DEFAULT_ALGORITHM, output_format: str = 'text', quiet: bool = False):
     """Print a list of indexed files in FOLDER."""
-    index = FileIndex(folder)
+    output = Output(output_format, quiet)
+    index = FileIndex(folder, algorithm)
+    index.log = output.message
     try:
         index.load()
     except IndexError as e:
-        print(e)
+        print(e, file=sys.stderr)
         sys.exit(1)
 
-    items = {}
+    if not by_size and not by_hash:
+        for row in index._rows():
+            f = index._file(row)
+            output.file(f, f"{row['path']} {f!r}")
+        return
+
     if by_size:
-        print("List items by size")
+        output.message("List items by size")
         items = index.by_size()
-    elif by_hash:
-        items = index.by_hash()
     else:
-        items = index.index
+        with HashPool(jobs, processes) as pool:
+            items = index.by_hash(pool)
+        index.save()
 
     for k, v in items.items():
-        print(k, v)
+        if output.format == 'text':
+            print(k, v)
+            continue
+        for f in v:
+            output.file(f)
 
 
 @cli.command()
 @click.argument("destination", type=click.Path(path_type=Path, file_okay=False, exists=True))
 @click.argument("source", type=click.Path(path_type=Path, file_okay=False, exists=True))
-@click.option("--min-size", type=int, help="Minimum file size to consider.")
-def compare(destination: Path, source: Path, min_size: int = 1):
-    """Check if all files in SOURCE exists in DESTINATION."""
-
-    print(
-        f"Check if all files in {source} of {min_size} bytes or more exists in {destination}.")
-
-    source_index = FileIndex(source)
-    destination_index = FileIndex(destination)
-
-    missing = source_index.missing_from(destination_index)
-
+@click.option("--min-size", type=int, default=1, show_default=True, help="Minimum file size to consider.")
+@click.option("--report", type=click.Path(path_type=Path, dir_okay=False),
+              help="Write the missing files, and those smaller than --min-size, as JSON Lines, for the delete command.")
+@pool_options
+@algorithm_option
+@fingerprint_option
+@output_options
+def compare(destination: Path, source: Path, min_size: int = 1, report: Optional[Path] = None,
+            jobs: int = DEFAULT_JOBS, processes: bool = False, algorithm: str = DEFAULT_ALGORITHM,
+            fingerprint_blocks: int = FINGERPRINT_BLOCKS, output_format: str = 'text', quiet: bool = False):
+    """Check if all files in SOURCE exists in DESTINATION.
+
+    In the text format the missing files are listed in order once the
+    comparison is done, in the other formats as they are found.
+    """
+    output = Output(output_format, quiet)
+    output.message(f"Check if all files in {source} of {min_size} bytes or more exists in {destination}.")
+
+    source_index = FileIndex(source, algorithm, fingerprint_blocks)
+    destination_index = FileIndex(destination, algorithm, fingerprint_blocks)
+    source_index.log = destination_index.log = output.message
+
+    missing: List[File] = []
+    with HashPool(jobs, processes) as pool, ExitStack() as stack:
+        # Written as the files are found, so nothing is kept for it.
+        report_file = stack.enter_context(atomic.atomic_write(report)) if report is not None else None
+        try:
+            for f in source_index.iter_missing_from(destination_index, pool, min_size):
+                if report_file is not None:
+                    report_file.write(report_line(f))
+                if output.format == 'text':
+                    missing.append(f)
+                else:
+                    output.file(f)
+            if report_file is not None:
+                # Never compared, so they are not known to be in destination either, and delete must keep them.
+                for f in source_index._files("size < ?", (min_size, )):
+                    report_file.write(report_line(f, compared=False))
+        finally:
+            source_index.save()
+            destination_index.save()
+
+    missing.sort(key=lambda f: f.path)
     for f in missing:
-        print(f)
+        output.file(f, repr(f))
+    output.message(pool.report())
 
 
 @cli.command()
 @click.argument("folder", type=click.Path(path_type=Path, file_okay=False, exists=True))
 @click.argument("missing_files", type=click.Path(path_type=Path, dir_okay=False, exists=True))
 @click.option("--delete", is_flag=True, help="Really delete files.")
-def delete(folder: Path, missing_files: Path, delete: bool = False):
-    """Delete all the files that are not missing when compared to some other folder."""
+@click.option("--trash", type=click.Path(path_type=Path, file_okay=False), default=Path("u/deleted"),
+              show_default=True, help="Folder deleted files are moved to.")
+@click.option("--jobs", "-j", type=int, default=DEFAULT_JOBS, show_default=True,
+              help="Number of files to move concurrently.")
+def delete(folder: Path, missing_files: Path, delete: bool = False, trash: Path = Path("u/deleted"),
+           jobs: int = DEFAULT_JOBS):
+    """Delete all the files that are not missing when compared to some other folder.
+
+    MISSING_FILES is a report written by compare --report. Files are moved
+    to the trash folder, and dropped from the index as they are, so an
+    interrupted run picks up where it stopped.
+    """
 
     if delete:
         print("THIS IS NOT A DRILL, FILES WILL BE DELETED!")
 
     print("Loading data from previous run")
-    missing_files_path: List[str] = []
-
-    filename_re = re.compile('<File (.*)>')
-
-    with open(missing_files) as f:
-        while line := f.readline():
-            file_path = filename_re.match(line)
-            if file_path:
-                missing_files_path.append(file_path.group(1))
+    missing_files_path = read_report(missing_files)
 
     print("Loading fileindex")
     folder_index = FileIndex(folder)
@@ -292,69 +1399,146 @@ def delete(folder: Path, missing_files: Path, delete: bool = False):
     folder_index.load()
 
     print("Running through files.")
-    for path, file_info in folder_index.index.items():
-        if not str(file_info.path) in missing_files_path:
-            if delete:
-                print(f"Will delete: {path}")
-                # Path(path).unlink()
-                destination = Path(f"u/deleted/{path}").parent
-                os.makedirs(destination, exist_ok=True)
-                try:
-                    shutil.move(file_info.path, f"u/deleted/{path}")
-                except FileNotFoundError:
-                    print("Skipping file not found.")
-            else:
-                print(f"File to delete: {path}")
-        else:
+    to_delete: List[File] = []
+    for file_info in folder_index._files():
+        path = folder_index._key(file_info)
+        if os.path.abspath(file_info.path) in missing_files_path:
             print(f"File missing from destination: {path}")
+        elif delete:
+            to_delete.append(file_info)
+        else:
+            print(f"File to delete: {path}")
+
+    moved = 0
+    moved_bytes = 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for batch in batched(to_delete, BATCH_SIZE):
+            keys = [folder_index._key(f) for f in batch]
+            destinations = [trash / key for key in keys]
+            for f, key, found in zip(batch, keys, executor.map(move_file, [f.path for f in batch], destinations)):
+                if found:
+                    print(f"Deleted: {key}")
+                    moved += 1
+                    moved_bytes += f.size
+                else:
+                    print(f"Skipping file not found: {key}")
+                folder_index.store.delete(key)
+            folder_index.save()
+
+    elapsed = time.perf_counter() - start
+    if to_delete and elapsed > 0:
+        megabytes = moved_bytes / (1024 * 1024)
+        print(f"Moved {moved} file(s), {megabytes:.1f} MB in {elapsed:.1f}s "
+              f"({moved / elapsed:.1f} files/s, {megabytes / elapsed:.1f} MB/s)")
 
 
 @cli.command()
 @click.argument("folder", type=click.Path(path_type=Path, file_okay=False, exists=True))
 @click.option("--min-size", type=int, help="Minimum file size to consider", default=1)
-def duplicates(folder: Path, min_size: int = 1):
-    """Find duplicate files within a folder."""
-
-    print("Loading fileindex")
-    folder_index = FileIndex(folder)
-    print("Reading file info")
+@click.option("--link", type=click.Choice(links.METHODS),
+              help="Replace duplicates by hard links or reflinks to one of them.")
+@click.option("--dry-run", is_flag=True, help="Only show what --link would do.")
+@pool_options
+@algorithm_option
+@fingerprint_option
+@output_options
+def duplicates(folder: Path, min_size: int = 1, link: Optional[str] = None, dry_run: bool = False,
+               jobs: int = DEFAULT_JOBS, processes: bool = False, algorithm: str = DEFAULT_ALGORITHM,
+               fingerprint_blocks: int = FINGERPRINT_BLOCKS, output_format: str = 'text', quiet: bool = False):
+    """Find duplicate files within a folder.
+
+    Hard links to the same file are not duplicates, and are only read once.
+    Records in the other formats than text are numbered by group.
+    """
+    output = Output(output_format, quiet)
+    output.message("Loading fileindex")
+    folder_index = FileIndex(folder, algorithm, fingerprint_blocks)
+    folder_index.log = output.message
+    output.message("Reading file info")
     folder_index.load()
 
-    files_by_size = folder_index.by_size()
-
-    for size, files in files_by_size.items():
-        if size < min_size:
-            print(f"Skipping {len(files)} file(s) of size {size}.")
-
-        hashes: Dict[str, List[File]] = {}
-        for file in files:
-            if not file.path.exists():
-                continue
-
-            if file.quickhash not in hashes:
-                hashes[file.quickhash] = []
-            hashes[file.quickhash].append(file)
-
-        for _, files in hashes.items():
-            if len(files) > 1:
-                long_hashes: Dict[str, List[File]] = {}
-                for file in files:
-                    long_hash = file.hash
-
-                    if long_hash not in long_hashes:
-                        long_hashes[long_hash] = []
+    reclaimed = 0
+    with HashPool(jobs, processes) as pool:
+        try:
+            for group, files in enumerate(folder_index.duplicates(pool, min_size), 1):
+                if output.format == 'text':
+                    print("Duplicate files: ")
+                for f in sorted(files, key=lambda x: x.path):
+                    output.file(f, group=group)
+
+                if link is not None:
+                    reclaimed += folder_index.link_duplicates(files, link, dry_run)
+                if output.format == 'text':
+                    print("")
+        finally:
+            folder_index.save()
+    if link is not None:
+        output.message(f"{'Would reclaim' if dry_run else 'Reclaimed'} {reclaimed / (1024 * 1024):.1f} MB")
+    output.message(pool.report())
+
+
+@cli.command("cross-duplicates")
+@click.argument("folders", nargs=-1, required=True, type=click.Path(path_type=Path, file_okay=False, exists=True))
+@click.option("--min-size", type=int, help="Minimum file size to consider", default=1)
+@pool_options
+@algorithm_option
+@fingerprint_option
+@output_options
+def cross_duplicates(folders: Tuple[Path, ...], min_size: int = 1, jobs: int = DEFAULT_JOBS, processes: bool = False,
+                     algorithm: str = DEFAULT_ALGORITHM, fingerprint_blocks: int = FINGERPRINT_BLOCKS,
+                     output_format: str = 'text', quiet: bool = False):
+    """Find files duplicated across the indexes of FOLDERS, and the bytes unique to each.
+
+    Records in the other formats than text are numbered by group and name
+    the folder whose index the file is in. The bytes unique to each folder
+    are then written to stderr.
+    """
+    output = Output(output_format, quiet)
+    indexes = IndexSet(folders, algorithm, fingerprint_blocks)
+    for index in indexes.indexes:
+        index.log = output.message
+    try:
+        indexes.load()
+    except IndexError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
 
-                    long_hashes[long_hash].append(file)
+    folder_of = {id(index): folder for folder, index in zip(folders, indexes.indexes)}
+    shared = {id(index): 0 for index in indexes.indexes}
+    with HashPool(jobs, processes) as pool:
+        try:
+            for group, files in enumerate(indexes.duplicates(pool, min_size), 1):
+                if output.format == 'text':
+                    print("Duplicate files: ")
+                for index, f in sorted(files, key=lambda x: x[1].path):
+                    shared[id(index)] += f.size
+                    output.file(f, group=group, index=str(folder_of[id(index)]))
+                if output.format == 'text':
+                    print("")
+        finally:
+            indexes.save()
+
+    summary = print if output.format == 'text' else output.message
+    for folder, index in zip(folders, indexes.indexes):
+        unique = index.total_size(min_size) - shared[id(index)]
+        summary(f"{folder}: {unique / (1024 * 1024):.1f} MB unique, {shared[id(index)] / (1024 * 1024):.1f} MB duplicated elsewhere")
+    output.message(pool.report())
 
-                for _, long_files in long_hashes.items():
-                    if len(long_files) > 1:
-                        print("Duplicate files: ")
-                        for f in sorted(long_files, key=lambda x: x.path):
-                            print(f.path)
 
-                        print("")
+@cli.command()
+@click.argument("folder", type=click.Path(path_type=Path, file_okay=False, exists=True))
+@click.argument("output", type=click.Path(path_type=Path, dir_okay=False))
+def export(folder: Path, output: Path):
+    """Export the indexed files in FOLDER as JSON to OUTPUT."""
+    index = FileIndex(folder)
+    try:
+        index.load()
+    except IndexError as e:
+        print(e)
+        sys.exit(1)
 
-    folder_index.save()
+    index.export_json(output)
 
 
 if __name__ == "__main__":
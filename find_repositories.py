@@ -5,6 +5,7 @@ import os
 import git
 from git import Repo
 
+from common.progress import tracker
 from common.logger import setup_logger
 logger = setup_logger(__file__)
 
@@ -13,6 +14,7 @@ def find_repositories():
     repositories = []
     for root, folders, files in os.walk('.'):
         logger.debug("In folder: {}".format(root))
+        tracker.count('walk', files=1, calls=1)
         if '.git' in folders:
             logger.info("Found repository in: {}".format(root))
             repositories.append(root)
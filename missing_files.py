@@ -1,8 +1,9 @@
 #!/usr/bin/env python3
 import os
 import sys
-import hashlib
 
+from common import hashing, walker
+from common.progress import tracker
 from common.logger import setup_logger
 logger = setup_logger(__file__)
 
@@ -11,36 +12,42 @@ Checks if all files in directory tree exists in another
 """
 
 class File(object):
-    def __init__(self, path):
+    def __init__(self, path, algorithm=None, size=None):
         # assert os.path.isfile(path), path
-        if not os.path.isfile(path):
-            return None
+        if size is None:
+            if not os.path.isfile(path):
+                return None
+            size = os.stat(path).st_size
         self.path = path
-        stat = os.stat(path)
-        self.size = stat.st_size
+        self.size = size
+        self.algorithm = algorithm or hashing.fastest()
         self._hash = None
         self._quickhash = None
+        self._fingerprint = None
 
     @property
     def hash(self):
-        block_size = 65536
         if self._hash is None:
-            self._hash = hashlib.md5()
-            with open(self.path, 'rb') as f:
-                fb = f.read(block_size)
-                while len(fb) > 0:
-                    self._hash.update(fb)
-                    fb = f.read(block_size)
-
-        return self._hash.hexdigest()
+            with tracker.timed('hash', files=1, bytes=self.size, calls=1):
+                self._hash = hashing.hash_file(self.path, self.algorithm)
+
+        return self._hash
     
     @property
     def quickhash(self):
-        self._quickhash = hashlib.md5()
-        with open(self.path, 'rb') as f:
-            self._quickhash.update(f.read(1024))
+        if self._quickhash is None:
+            with tracker.timed('quickhash', files=1, bytes=min(hashing.QUICKHASH_SIZE, self.size), calls=1):
+                self._quickhash = hashing.hash_head(self.path, algorithm=self.algorithm)
         
-        return self._quickhash.hexdigest()
+        return self._quickhash
+
+    @property
+    def fingerprint(self):
+        if self._fingerprint is None:
+            with tracker.timed('fingerprint', files=1, bytes=min(hashing.fingerprint_size(), self.size), calls=1):
+                self._fingerprint = hashing.fingerprint(self.path, algorithm=self.algorithm)
+
+        return self._fingerprint
 
     def equal(self, other):
         if self.size != other.size:
@@ -49,6 +56,10 @@ class File(object):
         if self.quickhash != other.quickhash:
             return False
 
+        # Sample the file before reading it all, unless that reads about as much.
+        if self.size > 2 * hashing.fingerprint_size() and self.fingerprint != other.fingerprint:
+            return False
+
         if self.hash != other.hash:
             return False
         
@@ -63,22 +74,19 @@ class Directory(object):
         self.content = []
         self.files_by_size = {}
 
-        for root, folders, files in os.walk(path):
-            for filename in files:
-                if not os.path.isfile(os.path.join(root, filename)):
-                    continue
-                fo = File(os.path.join(root, filename))
-                self.content.append(fo)
-                if fo.size not in self.files_by_size:
-                    self.files_by_size[fo.size] = []
-                self.files_by_size[fo.size].append(fo)
+        for entry in walker.files(path):
+            fo = File(entry.path, size=entry.size)
+            self.content.append(fo)
+            if fo.size not in self.files_by_size:
+                self.files_by_size[fo.size] = []
+            self.files_by_size[fo.size].append(fo)
 
     def has_file(self, fileobject: File) -> bool:
         if fileobject.size not in self.files_by_size:
             return False
         
         for fo in self.files_by_size[fileobject.size]:
-            if fo.quickhash == fileobject.quickhash and fo.hash == fileobject.hash:
+            if fo.equal(fileobject):
                 return True
 
         return False
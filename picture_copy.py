@@ -8,6 +8,8 @@ import datetime
 from pathlib import Path
 import pyexiv2
 
+from common import walker
+
 from logging import getLogger, basicConfig
 
 basicConfig()
@@ -32,16 +34,14 @@ class FileToCopy(TypedDict):
 def find_files(folder: Path):
     logger.info(f"Finding files in {folder}")
     found_files: List[PictureFile] = []
-    for root, _, files in os.walk(folder):
+    for root, files in walker.walk(folder):
         logger.info(f"Going into {root}")
-        for file in files:
-            file_info = Path(root) / file
-            stat = file_info.stat()
+        for entry in files:
             file_modification_time = datetime.datetime.fromtimestamp(
-                stat.st_mtime)
+                entry.mtime)
             found_files.append({
                 'folder': Path(root),
-                'filename': file,
+                'filename': entry.name,
                 'timestamp': file_modification_time
             })
 
@@ -1,7 +1,11 @@
+import io
 import os
 import shutil
+import tempfile
 import unittest
-from duplicates import Directory
+from contextlib import redirect_stdout
+from common import hashing
+from duplicates import Directory, files, similar_folders
 
 class TestDuplicates(unittest.TestCase):
     @staticmethod
@@ -71,4 +75,100 @@ class TestDuplicates(unittest.TestCase):
         self.assertFalse(a.has_child(d))
     
 
-
+    def test_hash(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        for name, content in (("x", b"one"), ("y", b"two"), ("z", b"three")):
+            os.makedirs(os.path.join(folder, name, "sub"))
+            with open(os.path.join(folder, name, "sub", "file.txt"), "wb") as f:
+                f.write(content)
+
+        directory = Directory(folder)
+        x, y, z = (directory.subdirectories[name] for name in ("x", "y", "z"))
+        # Same names, but a file of another size.
+        self.assertEqual(x.hash, y.hash)
+        self.assertNotEqual(x.hash, z.hash)
+        self.assertIs(directory.hash, directory.hash)
+
+        with open(os.path.join(folder, "x", "sub", "file.txt"), "wb") as f:
+            f.write(b"three")
+        sub = x.subdirectories["sub"]
+        sub.scan()
+        self.assertEqual(x.hash, z.hash)
+
+    def test_deep(self):
+        folder = tempfile.mkdtemp()
+        paths = [folder]
+        for _ in range(1500):
+            paths.append(os.path.join(paths[-1], "d"))
+            os.mkdir(paths[-1])
+        # Deeper than shutil.rmtree can recurse.
+        self.addCleanup(lambda: [os.rmdir(path) for path in reversed(paths)])
+
+        directory = Directory(folder)
+        self.assertEqual(directory.depth, 1500)
+        self.assertIsNotNone(directory.hash)
+        self.assertEqual(directory.duplicates(), {})
+
+        shallow = Directory(folder, max_depth=2)
+        self.assertEqual(shallow.depth, 2)
+        self.assertEqual(shallow.subdirectories["d"].subdirectories["d"].content, ["d"])
+        self.assertTrue(shallow.subdirectories["d"].subdirectories["d"].truncated)
+
+        # Folders that only look the same down to max_depth are not duplicates.
+        other = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, other)
+        for name, deep, file in (("a", "deep1", "f"), ("b", "deep2", "g")):
+            os.makedirs(os.path.join(other, name, "x", deep))
+            with open(os.path.join(other, name, "x", deep, file), "wb") as f:
+                f.write(b"content")
+        self.assertEqual(Directory(other).duplicates(), {})
+        for max_depth in (1, 2):
+            self.assertEqual(Directory(other, max_depth=max_depth).duplicates(), {})
+
+    def test_similar_folders(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        for name in ("backup", "copy", "other"):
+            os.makedirs(os.path.join(folder, "disk", name, "photos"))
+        for n in range(40):
+            for name in ("backup", "copy", "other"):
+                content = f"{name} {n}" if name == "other" else f"photo {n}"
+                with open(os.path.join(folder, "disk", name, "photos", f"{n}.jpg"), "w") as f:
+                    f.write(content.ljust(100))
+        # One renamed and one extra file in the copy, 40 of 42 features shared.
+        os.rename(os.path.join(folder, "disk", "copy", "photos", "0.jpg"), os.path.join(folder, "disk", "copy", "photos", "zero.jpg"))
+        with open(os.path.join(folder, "disk", "copy", "photos", "new.jpg"), "w") as f:
+            f.write("new")
+
+        disk = os.path.join(folder, "disk")
+        similar = similar_folders(folder, threshold=0.9, jobs=2)
+        # The photos folders are left out, as the folders they are in are similar already.
+        self.assertEqual(similar, [(39 / 42, os.path.join(disk, "backup"), os.path.join(disk, "copy"))])
+        self.assertEqual(similar_folders(folder, threshold=0.95, jobs=2), [])
+
+    def test_files(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        cwd = os.getcwd()
+        os.chdir(folder)
+        self.addCleanup(os.chdir, cwd)
+
+        # Larger than a fingerprint of one block reads, they differ in a byte it does not sample.
+        size = hashing.fingerprint_size(1) + 100000
+        data = bytes(size)
+        changed = bytearray(data)
+        changed[hashing.BLOCK_SIZE + 10] = 1
+        for name, content in (("a.bin", data), ("b.bin", data), ("c.bin", bytes(changed)),
+                              ("small1.txt", b"same"), ("small2.txt", b"same"), ("small3.txt", b"diff")):
+            with open(name, "wb") as f:
+                f.write(content)
+
+        output = io.StringIO()
+        with redirect_stdout(output):
+            files(algorithm='md5', jobs=2, blocks=1)
+        lines = output.getvalue().splitlines()
+        self.assertEqual(lines[:3], ["Found 6 files", "6 files in 2 sets", "4 files in 2 sets"])
+        self.assertEqual(lines[lines.index(f"Size: {size}") + 2:][:2], ["./a.bin", "./b.bin"])
+        self.assertEqual(lines[lines.index("Size: 4") + 2:][:2], ["./small1.txt", "./small2.txt"])
+        self.assertIn(f"Hash: {hashing.hash_bytes(data, 'md5')}", lines)
@@ -0,0 +1,396 @@
+import os
+import json
+import stat
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from pathlib import Path
+
+from click.testing import CliRunner
+
+from common import atomic
+from common.hashing import hash_file
+from file_index import File, FileIndex, HashPool, IndexSet, INDEX_FILE_NAME, INDEX_DB_NAME, cli, read_json_index, read_report
+
+
+class TestFileIndex(unittest.TestCase):
+    def setUp(self):
+        self.folder = Path(tempfile.mkdtemp())
+        (self.folder / "a").mkdir()
+        (self.folder / "a" / "one.txt").write_bytes(b"one")
+        (self.folder / "a" / "two.txt").write_bytes(b"two")
+        (self.folder / "three.txt").write_bytes(b"three")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_create(self):
+        index = FileIndex(self.folder)
+        index.update()
+        index.save()
+
+        loaded = FileIndex(self.folder)
+        loaded.load()
+        self.assertEqual(sorted(loaded.index.keys()), ["a/one.txt", "a/two.txt", "three.txt"])
+        self.assertNotIn(INDEX_DB_NAME, loaded.index)
+
+    def test_incremental_update(self):
+        index = FileIndex(self.folder)
+        index.update()
+        index.save()
+
+        # Mark an unchanged entry so we can tell it was reused, not re-read.
+        with sqlite3.connect(self.folder / INDEX_DB_NAME) as connection:
+            connection.execute("UPDATE files SET quickhash = 'reused' WHERE path = 'a/one.txt'")
+
+        (self.folder / "a" / "two.txt").write_bytes(b"changed")
+        (self.folder / "three.txt").unlink()
+        (self.folder / "four.txt").write_bytes(b"four")
+
+        index = FileIndex(self.folder)
+        index.update(incremental=True)
+
+        files = index.index
+        self.assertEqual(sorted(files.keys()), ["a/one.txt", "a/two.txt", "four.txt"])
+        self.assertEqual(files["a/one.txt"].quickhash, "reused")
+        self.assertEqual(files["a/two.txt"].size, len(b"changed"))
+
+    def test_migrate_json(self):
+        index = FileIndex(self.folder)
+        index.update()
+        index.export_json(self.folder / INDEX_FILE_NAME)
+        index.store.close()
+        (self.folder / INDEX_DB_NAME).unlink()
+
+        loaded = FileIndex(self.folder / "a")
+        loaded.load()
+        self.assertTrue((self.folder / INDEX_DB_NAME).is_file())
+        self.assertEqual(sorted(loaded.index.keys()), ["a/one.txt", "a/two.txt"])
+        self.assertEqual(len(loaded.by_size()), 1)
+
+    def test_by_size_and_hash(self):
+        (self.folder / "copy.txt").write_bytes(b"one")
+        index = FileIndex(self.folder)
+        index.update(stat_only=True)
+
+        self.assertEqual({size: sorted(f.name for f in files) for size, files in index.by_size().items()},
+                         {3: ["copy.txt", "one.txt", "two.txt"], 5: ["three.txt"]})
+        with HashPool(2) as pool:
+            by_hash = index.by_hash(pool)
+        self.assertEqual(pool.files, 4)
+        self.assertEqual(sorted(f.name for f in by_hash[hash_file(self.folder / "copy.txt")]), ["copy.txt", "one.txt"])
+        self.assertEqual(len(by_hash), 3)
+
+        # The quickhashes were stored, so nothing is read again.
+        with HashPool(1) as pool:
+            self.assertEqual(index.by_hash(pool).keys(), by_hash.keys())
+        self.assertEqual(pool.files, 0)
+
+    def test_migrate_truncated_json(self):
+        (self.folder / INDEX_FILE_NAME).write_text('{\n    "three.txt": {"size": 5, "quickhash": null')
+        with self.assertRaises(ValueError):
+            FileIndex(self.folder).load()
+        # Nothing is left behind, so the next run tries again.
+        self.assertEqual(sorted(p.name for p in self.folder.iterdir()), sorted(["a", INDEX_FILE_NAME, "three.txt"]))
+
+    def test_stat_only(self):
+        index = FileIndex(self.folder)
+        index.update(stat_only=True)
+        index.save()
+        index.store.close()
+
+        with sqlite3.connect(self.folder / INDEX_DB_NAME) as connection:
+            self.assertEqual(connection.execute("SELECT COUNT(*) FROM files WHERE quickhash IS NOT NULL").fetchone()[0], 0)
+
+        result = CliRunner().invoke(cli, ["duplicates", str(self.folder)])
+        self.assertEqual(result.exit_code, 0, result.output)
+
+        # Only the two files sharing a size were hashed, and the result was kept.
+        with sqlite3.connect(self.folder / INDEX_DB_NAME) as connection:
+            hashed = connection.execute("SELECT path FROM files WHERE quickhash IS NOT NULL ORDER BY path").fetchall()
+        self.assertEqual([p for p, in hashed], ["a/one.txt", "a/two.txt"])
+
+    def test_export_formats(self):
+        umask = os.umask(0o022)
+        self.addCleanup(os.umask, umask)
+        index = FileIndex(self.folder)
+        index.update()
+        index.save()
+        expected = {k: v.to_dict(self.folder) for k, v in index.index.items()}
+
+        for name in ["index.json", "index.json.gz", "index.json.zst"]:
+            if name.endswith(".zst") and atomic.zstandard is None:
+                continue
+            exported = self.folder / name
+            index.export_json(exported)
+            self.assertEqual(dict(read_json_index(exported)), expected)
+
+        # New files get the umask's permissions, replaced files keep theirs.
+        self.assertEqual(stat.S_IMODE(os.stat(self.folder / "index.json").st_mode), 0o644)
+        os.chmod(self.folder / "index.json", 0o640)
+        index.export_json(self.folder / "index.json")
+        self.assertEqual(stat.S_IMODE(os.stat(self.folder / "index.json").st_mode), 0o640)
+
+        # Indented files from older versions are still read.
+        legacy = self.folder / "legacy.json"
+        with open(legacy, 'w') as f:
+            json.dump(expected, f, indent=4)
+        self.assertEqual(dict(read_json_index(legacy)), expected)
+
+        # An export cut off between two entries is not taken as complete.
+        truncated = self.folder / "truncated.json"
+        truncated.write_text("".join((self.folder / "index.json").read_text().splitlines(keepends=True)[:-1]))
+        with self.assertRaises(ValueError):
+            dict(read_json_index(truncated))
+
+    def test_scope(self):
+        (self.folder / "ab").mkdir()
+        (self.folder / "ab" / "other.txt").write_bytes(b"other")
+        (self.folder / "a.txt").write_bytes(b"a")
+        created = FileIndex(self.folder)
+        created.update()
+        created.save()
+
+        index = FileIndex(self.folder / "a")
+        index.load()
+        files = index.index
+        self.assertEqual(sorted(files.keys()), ["a/one.txt", "a/two.txt"])
+        self.assertIs(index.index, files)
+
+        index.add_file(files["a/one.txt"])
+        self.assertIsNot(index.index, files)
+
+        # three.txt and ab/other.txt share a size too, but are not below a.
+        self.assertEqual([(size, len(group)) for size, group in created.size_collisions()], [(3, 2), (5, 2)])
+        self.assertEqual([(size, len(group)) for size, group in index.size_collisions()], [(3, 2)])
+
+    def test_duplicates(self):
+        header = bytes(2 * 1024 * 1024)
+        (self.folder / "big1.bin").write_bytes(header + b"same")
+        (self.folder / "a" / "big2.bin").write_bytes(header + b"same")
+        (self.folder / "big3.bin").write_bytes(header + b"diff")
+        (self.folder / "a" / "three.txt").write_bytes(b"three")
+
+        index = FileIndex(self.folder)
+        index.update(stat_only=True)
+        groups = [sorted(str(f.path.relative_to(self.folder)) for f in files) for files in index.duplicates()]
+
+        self.assertEqual(sorted(groups), [["a/big2.bin", "big1.bin"], ["a/three.txt", "three.txt"]])
+
+        # The file differing only at the end was told apart without a full read.
+        big3 = index.index["big3.bin"]
+        self.assertIsNotNone(big3._fingerprint)
+        self.assertIsNone(big3._hash)
+
+        # With every hash in the index, a deleted file is still noticed.
+        (self.folder / "three.txt").unlink()
+        groups = [sorted(str(f.path.relative_to(self.folder)) for f in files) for files in index.duplicates()]
+        self.assertEqual(groups, [["a/big2.bin", "big1.bin"]])
+
+    def test_missing_from(self):
+        destination = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, destination)
+        header = bytes(2 * 1024 * 1024)
+        (self.folder / "big.bin").write_bytes(header + b"source")
+        (destination / "copy.bin").write_bytes(header + b"target")
+        shutil.copy(self.folder / "a" / "one.txt", destination / "one.txt")
+
+        for folder in (self.folder, destination):
+            index = FileIndex(folder)
+            index.update(stat_only=True)
+            index.save()
+
+        source_index, destination_index = FileIndex(self.folder), FileIndex(destination)
+        missing = source_index.missing_from(destination_index)
+        self.assertEqual(sorted(str(f.path.relative_to(self.folder)) for f in missing),
+                         ["a/two.txt", "big.bin", "three.txt"])
+        source_index.save()
+        destination_index.save()
+
+        # Hashes computed while comparing were stored in both indexes.
+        with sqlite3.connect(destination / INDEX_DB_NAME) as connection:
+            self.assertEqual(connection.execute("SELECT quickhash IS NOT NULL FROM files WHERE path = 'one.txt'").fetchone(), (1, ))
+            self.assertIsNotNone(connection.execute("SELECT fingerprint FROM files WHERE path = 'copy.bin'").fetchone()[0])
+
+        missing = FileIndex(self.folder).missing_from(FileIndex(destination), min_size=4)
+        self.assertEqual(sorted(str(f.path.relative_to(self.folder)) for f in missing), ["big.bin", "three.txt"])
+
+    def test_compare_within_one_index(self):
+        (self.folder / "b").mkdir()
+        (self.folder / "b" / "one.txt").write_bytes(b"one")
+        index = FileIndex(self.folder)
+        index.update(stat_only=True)
+        index.save()
+
+        result = CliRunner().invoke(cli, ["compare", str(self.folder / "b"), str(self.folder / "a")])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn(repr(File(self.folder / "a" / "two.txt")), result.output)
+        self.assertNotIn(repr(File(self.folder / "a" / "one.txt")), result.output)
+
+        result = CliRunner().invoke(cli, ["cross-duplicates", str(self.folder), str(self.folder / "b")])
+        self.assertEqual(result.exit_code, 0, result.output)
+
+    def test_apply_changes(self):
+        os.symlink(self.folder / "three.txt", self.folder / "link.txt")
+        index = FileIndex(self.folder)
+        index.update()
+
+        (self.folder / "a" / "one.txt").write_bytes(b"changed")
+        shutil.move(self.folder / "a", self.folder / "b")
+        (self.folder / "four.txt").write_bytes(b"four")
+        changed = [str(self.folder / name) for name in ("a", "b", "four.txt", INDEX_DB_NAME)]
+
+        self.assertEqual(index.apply_changes(changed), (3, 2))
+        files = index.index
+        self.assertEqual(sorted(files.keys()), ["b/one.txt", "b/two.txt", "four.txt", "link.txt", "three.txt"])
+        self.assertEqual(files["b/one.txt"].size, len(b"changed"))
+        self.assertEqual(files["four.txt"].quickhash, hash_file(self.folder / "four.txt"))
+
+        # A symbolic link to a file is indexed by the walker, so it is kept.
+        self.assertEqual(index.apply_changes([str(self.folder / "link.txt")]), (0, 0))
+        self.assertIn("link.txt", index.index)
+
+    def test_index_set(self):
+        other = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, other)
+        (self.folder / "four.txt").write_bytes(b"four")
+        (self.folder / "a" / "four.txt").write_bytes(b"four")
+        shutil.copy(self.folder / "a" / "one.txt", other / "one.txt")
+        (other / "two.txt").write_bytes(b"TWO")
+        (other / "five.txt").write_bytes(b"five")
+
+        for folder in (self.folder, other):
+            index = FileIndex(folder)
+            index.update(stat_only=True)
+            index.save()
+
+        indexes = IndexSet([self.folder, other])
+        indexes.load()
+        self.assertEqual([size for size, _ in indexes.shared_sizes()], [3, 4])
+
+        groups = [sorted((index.path, f.path.name) for index, f in group) for group in indexes.duplicates()]
+        self.assertEqual(groups, [sorted([(self.folder, "one.txt"), (other, "one.txt")])])
+        indexes.save()
+
+        result = CliRunner().invoke(cli, ["cross-duplicates", str(self.folder), str(other)])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn(f"{other}: 0.0 MB unique", result.output)
+
+    def test_link_duplicates(self):
+        (self.folder / "copy.txt").write_bytes(b"one")
+        os.link(self.folder / "a" / "one.txt", self.folder / "link.txt")
+        index = FileIndex(self.folder)
+        index.update(stat_only=True)
+
+        with HashPool(1) as pool:
+            groups = [g for g in index.duplicates(pool)]
+        self.assertEqual(len(groups), 1)
+        # Four files of three bytes, but only one of the hard links was read.
+        self.assertEqual(pool.files, 3)
+
+        self.assertEqual(index.link_duplicates(groups[0], 'hardlink', dry_run=True), 3)
+        self.assertEqual(os.stat(self.folder / "copy.txt").st_nlink, 1)
+        self.assertEqual(index.link_duplicates(groups[0], 'hardlink'), 3)
+        self.assertEqual(os.stat(self.folder / "copy.txt").st_nlink, 3)
+        self.assertEqual([g for g in index.duplicates()], [])
+
+    def test_link_changed(self):
+        (self.folder / "copy.txt").write_bytes(b"one")
+        (self.folder / "gone.txt").write_bytes(b"one")
+        index = FileIndex(self.folder)
+        index.update()
+        groups = [g for g in index.duplicates()]
+        index.save()
+
+        # Same size and times, other content, after the hashes were stored.
+        copy = self.folder / "copy.txt"
+        copy_stat = os.stat(copy)
+        copy.write_bytes(b"new")
+        os.utime(copy, ns=(copy_stat.st_atime_ns, copy_stat.st_mtime_ns))
+        os.remove(self.folder / "gone.txt")
+
+        index = FileIndex(self.folder)
+        index.load()
+        groups = [g for g in index.duplicates()]
+        self.assertEqual(len(groups), 1)
+        self.assertEqual(index.link_duplicates(groups[0], 'hardlink'), 0)
+        self.assertEqual(copy.read_bytes(), b"new")
+        self.assertEqual(os.stat(copy).st_nlink, 1)
+
+    def test_delete(self):
+        destination = Path(tempfile.mkdtemp())
+        trash = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, destination)
+        self.addCleanup(shutil.rmtree, trash)
+        shutil.copy(self.folder / "a" / "one.txt", destination / "one.txt")
+        # Below the default --min-size, so never compared, and not in destination either.
+        (self.folder / "empty.txt").write_bytes(b"")
+        for folder in (self.folder, destination):
+            index = FileIndex(folder)
+            index.update()
+            index.save()
+
+        report = self.folder.parent / f"{self.folder.name}.jsonl"
+        self.addCleanup(report.unlink)
+        result = CliRunner().invoke(cli, ["compare", str(destination), str(self.folder), "--report", str(report)])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(read_report(report), {str(self.folder / name) for name in ("a/two.txt", "three.txt", "empty.txt")})
+
+        result = CliRunner().invoke(cli, ["delete", str(self.folder), str(report), "--delete", "--trash", str(trash)])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(sorted(p.name for p in self.folder.rglob("*.txt")), ["empty.txt", "three.txt", "two.txt"])
+        self.assertTrue((trash / "a" / "one.txt").is_file())
+
+        index = FileIndex(self.folder)
+        index.load()
+        self.assertEqual(sorted(index.index.keys()), ["a/two.txt", "empty.txt", "three.txt"])
+
+    def test_output_formats(self):
+        (self.folder / "a" / "three.txt").write_bytes(b"three")
+        index = FileIndex(self.folder)
+        index.update()
+        index.save()
+
+        expected = [str(self.folder / "a" / "three.txt"), str(self.folder / "three.txt")]
+        result = CliRunner().invoke(cli, ["duplicates", str(self.folder), "--format", "jsonl"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        records = [json.loads(line) for line in result.stdout.splitlines()]
+        self.assertEqual([r['path'] for r in records], expected)
+        self.assertEqual({r['group'] for r in records}, {1})
+
+        result = CliRunner().invoke(cli, ["duplicates", str(self.folder), "--format", "null"])
+        self.assertEqual(result.stdout, "".join(path + "\0" for path in expected))
+
+        result = CliRunner().invoke(cli, ["list", str(self.folder), "--format", "csv", "--quiet"])
+        lines = result.stdout.splitlines()
+        self.assertEqual(lines[0], "path,size,quickhash,hash")
+        self.assertEqual(len(lines), 5)
+
+        # The report is written as missing files are found, in every format.
+        destination = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, destination)
+        empty = FileIndex(destination)
+        empty.update()
+        empty.save()
+        report = destination / "report.jsonl"
+        result = CliRunner().invoke(cli, ["compare", str(destination), str(self.folder / "a"), "--format", "null",
+                                          "--report", str(report)])
+        self.assertEqual(result.exit_code, 0, result.output)
+        paths = {str(self.folder / "a" / name) for name in ("one.txt", "two.txt", "three.txt")}
+        self.assertEqual(set(result.stdout.split("\0")[:-1]), paths)
+        self.assertEqual(read_report(report), paths)
+
+    def test_hash_pool(self):
+        files = [File(self.folder / "a" / "one.txt"), File(self.folder / "a" / "two.txt"), File(self.folder / "missing.txt", 0)]
+        with HashPool(4) as pool:
+            hashed = pool.hash(files)
+
+        self.assertEqual(len(hashed), 2)
+        for f in hashed:
+            self.assertEqual(f.hash, hash_file(f.path))
+        self.assertEqual(pool.bytes_read, 6)
+
+
+if __name__ == "__main__":
+    unittest.main()
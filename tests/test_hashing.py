@@ -0,0 +1,51 @@
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+
+from common import hashing
+
+
+class TestHashing(unittest.TestCase):
+    def setUp(self):
+        self.folder = Path(tempfile.mkdtemp())
+        self.data = bytes(range(256)) * 1000
+        self.path = self.folder / "data.bin"
+        self.path.write_bytes(self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_algorithms(self):
+        for algorithm in hashing.ALGORITHMS:
+            self.assertEqual(hashing.hash_file(self.path, algorithm), hashing.hash_bytes(self.data, algorithm))
+            self.assertEqual(hashing.hash_head(self.path, algorithm=algorithm),
+                             hashing.hash_bytes(self.data[:hashing.QUICKHASH_SIZE], algorithm))
+
+    def test_mmap(self):
+        empty = self.folder / "empty.bin"
+        empty.write_bytes(b"")
+        for path in (self.path, empty):
+            self.assertEqual(hashing.hash_file_mmap(path), hashing.hash_file(path))
+
+    def test_block_size(self):
+        self.assertEqual(hashing.block_size(0), hashing.BLOCK_SIZE)
+        self.assertEqual(hashing.block_size(10 ** 12), hashing.MAX_BLOCK_SIZE)
+
+    def test_fingerprint(self):
+        self.assertEqual(hashing.sample_offsets(0), [0])
+        offsets = hashing.sample_offsets(100 * hashing.BLOCK_SIZE, blocks=3)
+        self.assertEqual(offsets, [0, 99 * hashing.BLOCK_SIZE // 4, 99 * hashing.BLOCK_SIZE // 2,
+                                   3 * 99 * hashing.BLOCK_SIZE // 4, 99 * hashing.BLOCK_SIZE])
+        self.assertTrue(hashing.fingerprint(self.path, blocks=3).startswith("3:"))
+
+    def test_unknown_algorithm(self):
+        with self.assertRaises(ValueError):
+            hashing.new("crc0")
+
+    def test_fastest(self):
+        self.assertIn(hashing.fastest(), hashing.ALGORITHMS)
+
+
+if __name__ == "__main__":
+    unittest.main()
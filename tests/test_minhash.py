@@ -0,0 +1,41 @@
+import unittest
+
+from common import minhash
+
+
+def features(names):
+    return {minhash.feature(name.encode()) for name in names}
+
+
+class TestMinHash(unittest.TestCase):
+    def test_signature(self):
+        a = features(f"file{n}" for n in range(100))
+        b = features(f"file{n}" for n in range(5, 105))
+        c = features(f"other{n}" for n in range(100))
+
+        self.assertEqual(minhash.signature(a), minhash.signature(list(a)[::-1]))
+        self.assertAlmostEqual(minhash.similarity(minhash.signature(a), minhash.signature(b)),
+                               minhash.jaccard(a, b), delta=0.15)
+        self.assertLess(minhash.similarity(minhash.signature(a), minhash.signature(c)), 0.1)
+        self.assertEqual(minhash.signature(set()), minhash.empty())
+        self.assertTrue(all(0 <= x < minhash.PRIME for x in a))
+
+        half = len(a) // 2
+        parts = [sorted(a)[:half], sorted(a)[half:]]
+        self.assertEqual(minhash.merge(*(minhash.signature(part) for part in parts)), minhash.signature(a))
+
+    def test_bands(self):
+        for threshold in (0.5, 0.8, 0.95):
+            count, rows = minhash.bands(threshold)
+            self.assertLessEqual(count * rows, minhash.PERMUTATIONS)
+            self.assertGreaterEqual(1 - (1 - threshold ** rows) ** count, minhash.RECALL)
+        self.assertGreater(minhash.bands(0.95)[1], minhash.bands(0.5)[1])
+
+    def test_lsh(self):
+        lsh = minhash.LSH(0.9)
+        base = [f"file{n}" for n in range(200)]
+        lsh.add('a', minhash.signature(features(base)))
+        lsh.add('b', minhash.signature(features(base[:-2] + ["renamed", "extra"])))
+        lsh.add('c', minhash.signature(features(f"other{n}" for n in range(200))))
+
+        self.assertEqual([(a, b) for a, b in lsh.candidates()], [('a', 'b')])
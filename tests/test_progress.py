@@ -0,0 +1,69 @@
+import io
+import json
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+
+from common import progress, walker
+from duplicates import Directory
+
+
+class TestProgress(unittest.TestCase):
+    def test_count(self):
+        tracker = progress.Progress()
+        tracker.count('hash', files=2, bytes=2048, calls=2, misses=2, busy=0.5)
+        tracker.count('hash', files=1, hits=1)
+        with tracker.timed('save', files=1, calls=1):
+            pass
+
+        phase = tracker.phase('hash')
+        self.assertEqual((phase.files, phase.bytes, phase.calls), (3, 2048, 2))
+        self.assertAlmostEqual(phase.hit_rate, 1 / 3)
+        self.assertGreaterEqual(phase.wall, 0.5)
+
+        summary = tracker.summary()
+        self.assertEqual(sorted(summary['phases']), ['hash', 'save'])
+        self.assertEqual(summary['phases']['save']['calls'], 1)
+        json.dumps(summary)
+
+    def test_eta(self):
+        phase = progress.Phase('quickhash')
+        phase.started, phase.updated = 0.0, 10.0
+        phase.files = 100
+        self.assertIsNone(phase.eta)
+        phase.total = 400
+        self.assertEqual(phase.eta, 30.0)
+        self.assertIn("ETA 0:00:30", phase.describe())
+
+    def test_live_and_stats(self):
+        folder = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, folder)
+        stream = io.StringIO()
+        tracker = progress.Progress(live=True, stats=str(folder / "stats.json"), stream=stream)
+        tracker.count('walk', files=1, calls=1)
+        tracker.finish()
+
+        self.assertTrue(stream.getvalue().startswith("\rwalk 1"))
+        with open(folder / "stats.json") as f:
+            self.assertEqual(json.load(f)['phases']['walk']['files'], 1)
+
+    def test_walker_reports(self):
+        folder = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, folder)
+        (folder / "a").mkdir()
+        (folder / "a" / "one.txt").write_bytes(b"one")
+
+        walk, stat = progress.tracker.phase('walk'), progress.tracker.phase('stat')
+        before = (walk.files, stat.files)
+        [e for e in walker.files(folder, jobs=1)]
+        self.assertEqual((walk.files - before[0], stat.files - before[1]), (2, 1))
+
+        # duplicates.py --folders scans on its own, and reports the same way.
+        before = (walk.files, stat.files)
+        Directory(str(folder))
+        self.assertEqual((walk.files - before[0], stat.files - before[1]), (2, 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,43 @@
+import os
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+
+from common import walker
+
+
+class TestWalker(unittest.TestCase):
+    def setUp(self):
+        self.folder = Path(tempfile.mkdtemp())
+        for d in ["a/b/c", "a/.git", "d"]:
+            (self.folder / d).mkdir(parents=True)
+        for f in ["a/one.txt", "a/b/two.txt", "a/b/c/three.txt", "a/.git/config", "d/four.tmp"]:
+            (self.folder / f).write_bytes(f.encode('utf8'))
+        os.symlink(self.folder / "a", self.folder / "d" / "link")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def relative(self, entries):
+        return sorted(os.path.relpath(e.path, self.folder) for e in entries)
+
+    def test_files(self):
+        for jobs in (1, 4):
+            entries = [e for e in walker.files(self.folder, jobs=jobs)]
+            self.assertEqual(self.relative(entries),
+                             ["a/.git/config", "a/b/c/three.txt", "a/b/two.txt", "a/one.txt", "d/four.tmp"])
+            for e in entries:
+                self.assertEqual(e.size, os.stat(e.path).st_size)
+
+    def test_ignores(self):
+        entries = walker.files(self.folder, ignores=[".git", "*.tmp"], jobs=4)
+        self.assertEqual(self.relative(entries), ["a/b/c/three.txt", "a/b/two.txt", "a/one.txt"])
+
+    def test_walk(self):
+        directories = [os.path.relpath(d, self.folder) for d, _ in walker.walk(self.folder, jobs=1)]
+        self.assertEqual(directories, [".", "a", "a/.git", "a/b", "a/b/c", "d"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+import os
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+
+from common import watcher
+
+
+class TestWatcher(unittest.TestCase):
+    def setUp(self):
+        self.folder = Path(tempfile.mkdtemp())
+        (self.folder / "a").mkdir()
+        (self.folder / "a" / "one.txt").write_bytes(b"one")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def inotify(self):
+        try:
+            return watcher.Inotify(str(self.folder), ["*.db"])
+        except OSError as e:
+            self.skipTest(f"inotify not available: {e}")
+
+    def read_all(self, inotify):
+        changed = set()
+        while more := inotify.read(0.1):
+            changed |= more
+        return {os.path.relpath(path, self.folder) for path in changed}
+
+    def test_inotify(self):
+        with self.inotify() as inotify:
+            (self.folder / "a" / "one.txt").write_bytes(b"changed")
+            (self.folder / "two.txt").write_bytes(b"two")
+            (self.folder / "index.db").write_bytes(b"ignored")
+            self.assertEqual(self.read_all(inotify), {"a/one.txt", "two.txt"})
+
+            # New directories are watched too.
+            (self.folder / "b").mkdir()
+            self.assertEqual(self.read_all(inotify), {"b"})
+            (self.folder / "b" / "three.txt").write_bytes(b"three")
+            shutil.move(self.folder / "a", self.folder / "c")
+            self.assertEqual(self.read_all(inotify), {"a", "b/three.txt", "c"})
+
+    def test_changes(self):
+        self.inotify().close()
+        # Changes made before the first value is asked for are reported.
+        changes = watcher.changes(self.folder, ["*.db"], delay=0.1)
+        (self.folder / "two.txt").write_bytes(b"two")
+        changed = next(changes)
+        changes.close()
+        self.assertEqual({os.path.relpath(path, self.folder) for path in changed}, {"two.txt"})
+
+    def test_poll(self):
+        changes = watcher.poll(self.folder, ["*.db"], interval=0)
+        (self.folder / "a" / "one.txt").write_bytes(b"changed")
+        (self.folder / "two.txt").write_bytes(b"two")
+        (self.folder / "index.db").write_bytes(b"ignored")
+        changed = next(changes)
+        self.assertEqual({os.path.relpath(path, self.folder) for path in changed}, {"a/one.txt", "two.txt"})
+
+
+if __name__ == "__main__":
+    unittest.main()